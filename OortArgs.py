@@ -48,22 +48,43 @@ class OortArgParser:
     parser = None
     description = None
     userArgs = None
+    pendingArgs = None
+    parsedArgs = None
     
     def __init__(self, programDescription: str = None):
         if programDescription is not None:
             self.description = programDescription
-        self.parser = argparse.ArgumentParser(description=self.description)
-        self.parser.add_argument("-v", "--verbosity", type=int, choices=[0, 1, 2], help="increase output verbosity")
-        self.parser.add_argument("-c", "--config-dir", type=pathlib.Path, help="path to oort-config (configuration files) directory")
-        self.parser.add_argument("-b", "--build-dir", type=pathlib.Path, help="path to oort-build (build products) directory")
+        # Building the argparse parser is deferred until the arguments are actually needed;
+        # until then, argument definitions are just queued up
+        self.pendingArgs = list()
+        self.addArg("-v", "--verbosity", type=int, choices=[0, 1, 2], help="increase output verbosity")
+        self.addArg("-c", "--config-dir", type=pathlib.Path, help="path to oort-config (configuration files) directory")
+        self.addArg("-b", "--build-dir", type=pathlib.Path, help="path to oort-build (build products) directory")
         
-        operationGroup = self.parser.add_mutually_exclusive_group()
-        operationGroup.add_argument("-d", "--default-operation", action='store_true', default=False, help="run this tool normally (this is the default)")
-        operationGroup.add_argument("-l", "--list-hosts", action='store_true', default=False, help="instead of running this tool, list all defined hostnames and exit")
+        self.addArgGroup([
+            (("-d", "--default-operation"), dict(action='store_true', default=False, help="run this tool normally (this is the default)")),
+            (("-l", "--list-hosts"), dict(action='store_true', default=False, help="instead of running this tool, list all defined hostnames and exit")),
+        ], mutuallyExclusive=True)
+
+
+    def buildParser(self):
+        if self.parser is None:
+            self.parser = argparse.ArgumentParser(description=self.description)
+        for group, mutuallyExclusive, argDefs in self.pendingArgs:
+            target = self.parser
+            if group:
+                target = self.parser.add_mutually_exclusive_group() if mutuallyExclusive else self.parser.add_argument_group()
+            for args, kwargs in argDefs:
+                target.add_argument(*args, **kwargs)
+        self.pendingArgs = list()
+        return self.parser
 
 
     def getArgs(self):
-        return self.parser.parse_args()
+        # parse the command line only once; addArg() invalidates the cached result
+        if self.parsedArgs is None:
+            self.parsedArgs = self.buildParser().parse_args()
+        return self.parsedArgs
 
 
     def get(self, key):
@@ -71,4 +92,10 @@ class OortArgParser:
 
     
     def addArg(self, *args, **kwargs):
-        self.parser.add_argument(*args, **kwargs)
+        self.pendingArgs.append((False, False, [(args, kwargs)]))
+        self.parsedArgs = None
+
+
+    def addArgGroup(self, argDefs: list, mutuallyExclusive: bool = False):
+        self.pendingArgs.append((True, mutuallyExclusive, argDefs))
+        self.parsedArgs = None
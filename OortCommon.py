@@ -56,23 +56,33 @@ from machdep import machdepInit
 
 
 # STANDARD LIBRARIES
+# (hashlib, platform, shutil, and socket are imported where they are used, to keep startup fast)
+from collections import ChainMap
 import csv
-import hashlib
-from ipaddress import ip_address, IPv4Address
+import functools
 import json
+import mmap
 import os
-import platform
 import re
-import shutil
-import socket
+import stat
 import string
 import sys
+import threading
+
+
+# OPTIONAL EXTERNAL LIBRARIES
+try:
+    import orjson
+    jsonLoads = orjson.loads
+except ImportError:
+    jsonLoads = json.loads
 
 
 #
 # CONSTANTS
 #
 CSV_COMMENT_START =          "#"
+CSV_READ_BUFFER_SIZE =       1024 * 1024 # read CSV files through a 1MB buffer
 JSON_FILE_EXTENSION =        "json"
 JSON_COMMENT_KEY =           "__COMMENT_FILENAME__"
 
@@ -115,6 +125,14 @@ HOSTMAP_FIELD_ADMIN_IP =     "ADMIN_IP"
 HOSTMAP_FIELD_MACADDR =      "MAC"
 HOSTMAP_FIELD_OPTIONS_DICT = "options"
 
+# Hostmap field naming each host's subdirectory within a domain directory (the common domain has none)
+DOMAIN_HOSTMAP_FIELDS = {
+    DOMAIN_REALM:            HOSTMAP_FIELD_REALM,
+    DOMAIN_ROLE:             HOSTMAP_FIELD_ROLE,
+    DOMAIN_BOARD:            HOSTMAP_FIELD_BOARD,
+    DOMAIN_HOST:             HOSTMAP_FIELD_HOSTNAME,
+}
+
 HOST_ROLE_VIRTUAL =          "VIRTUAL"
 
 OSFLAVOR_STABLE =            "stable"
@@ -132,6 +150,7 @@ BOARDMAP_FIELD_BOOTLOADER_BOARDNAME = "BOOTLOADER_BOARD_NAME"
 BOARDMAP_FIELD_BOOT_DEVICES = "INSTALL_BOOT_DEVICES"
 BOARDMAP_FIELD_IMAGE_INFIX = "INSTALL_IMAGE_NAME_INFIX"
 BOARDMAP_FIELD_FLASH_OPTIONS = "flashOptions" # not stored in BOARDMAP.csv; see _FLASHOPTIONS.json
+BOARDMAP_FIELD_FLASH_IMAGE_OPTIONS = "flashImageOptions" # not stored in BOARDMAP.csv; 'images' entry of _FLASHOPTIONS.json
 
 
 #### Host options file
@@ -141,6 +160,7 @@ HOSTOPTIONS_KEY_INSTALLURL  = "etc-install-url"
 
 FLASHOPTIONS_FILENAME =      "_FLASHOPTIONS.json"
 HOSTOPTIONS_FILENAME =       "_OPTIONS.json"
+HOSTOPTIONS_LOADER_THREADS = 8 # maximum number of options files to read concurrently
 
 OPENBSD_VERSION_FILENAME =   "RELEASE.txt"
 
@@ -152,6 +172,17 @@ NETBOOT_APACHE_ACCESS_LOG_FILENAME = "apache_access.log"
 NETBOOT_APACHE_ERROR_LOG_FILENAME = "apache_error.log"
 
 SHA256_READ_CHUNK_SIZE =     1024 * 1024 # read a file in chunks of 1MB when computing SHA256 hash
+FILE_COPY_CHUNK_SIZE =       4 * 1024 * 1024 # copy files in chunks of 4MB where no kernel-assisted copy is available
+
+WHITESPACE_CHARACTERS =      frozenset(string.whitespace)
+TOKEN_PATTERN =              re.compile("[^" + re.escape(string.whitespace) + "]+") # non-empty and without whitespace
+MAC_ADDRESS_PATTERN =        re.compile("[0-9a-f]{2}([-:]?)[0-9a-f]{2}(\\1[0-9a-f]{2}){4}$")
+OPENBSD_VERSION_PATTERN =    re.compile(r"\d{2,3}")
+DOMAIN_NAME_PATTERN =        re.compile(
+    r'^(?=.{1,253}$)'                                       # overall length limit
+    r'(?:[a-zA-Z0-9](?:[-_a-zA-Z0-9]{0,61}[a-zA-Z0-9])?\.)+' # one or more labels, each 1-63 characters
+    r'[a-zA-Z][-a-zA-Z0-9]{0,61}[a-zA-Z0-9]$'               # top-level domain, including punycode ('xn--p1ai')
+)
 
 #
 # GLOBAL VARIABLES
@@ -159,18 +190,23 @@ SHA256_READ_CHUNK_SIZE =     1024 * 1024 # read a file in chunks of 1MB when com
 # Persistent
 gConfig = dict()
 gLatestOpenBsdStableVersion = None
+gOpenBsdVersionByFlavor = dict()    # key: OS flavor, value: OpenBSD version string
 gVerboseLogs = True
 gCsvCache = dict()
+gCacheLock = threading.RLock()  # guards lazy population of gCsvCache and gBoardmap
 gBoardmap = None
 gHostMap = None
+gHostMapByName = None   # key: hostname, value: host definition from gHostMap
+gSha256Cache = dict()   # key: (path, mtime in ns, size), value: raw digest bytes
 
 #
 # METHODS
 #
-def debug(s):
+def debug(s, *args):
+    # any args are %-formatted into s only if the message is actually printed
     global gVerboseLogs
     if gVerboseLogs:
-        print(s)
+        print(s % args if args else s)
 
 
 def error(s):
@@ -178,13 +214,20 @@ def error(s):
 
 
 def containsWhitespace(s):
-    return True in [c in s for c in string.whitespace]
+    return not WHITESPACE_CHARACTERS.isdisjoint(s)
     
         
+@functools.lru_cache(maxsize=None)
+def variableNamesPattern(variableNames):
+    return re.compile("|".join(re.escape(k) for k in variableNames))
+
+
 def replaceVariablesInString(text, varSubs):
-    varSubs = dict((re.escape(k), v) for k, v in varSubs.items()) 
-    pattern = re.compile("|".join(varSubs.keys()))
-    return pattern.sub(lambda m: varSubs[re.escape(m.group(0))], text)
+    # The compiled pattern only depends on the variable names, so it is cached and shared by tables with the same names.
+    # Longest names come first so that a variable which is a prefix of another (e.g. $ROOT and $ROOT_DIR)
+    # can't shadow it in the alternation; this also makes the cache key independent of dict order.
+    pattern = variableNamesPattern(tuple(sorted(varSubs, key=lambda k: (-len(k), k))))
+    return pattern.sub(lambda m: varSubs[m.group(0)], text)
     
 
 def makeDirIfNeeded(path):
@@ -195,37 +238,103 @@ def assertNotRootUser():
     assert os.geteuid() > 0, "It is not safe to invoke this script as root. Re-run it as a normal user."
 
     
+def sha256CacheKey(path, st):
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def cachedSha256(path):
+    return gSha256Cache.get(sha256CacheKey(path, os.stat(path)))
+
+
+def rememberSha256(path, sha256):
+    # Record a digest computed elsewhere (e.g. while downloading) so that sha256() needn't re-read the file
+    global gSha256Cache
+    gSha256Cache[sha256CacheKey(path, os.stat(path))] = sha256
+
+
+def filesHaveSameContents(pathA, pathB):
+    # If both files have already been hashed (e.g. when verifying downloads), compare the digests...
+    digestA = cachedSha256(pathA)
+    digestB = cachedSha256(pathB)
+    if digestA is not None and digestB is not None:
+        return digestA == digestB
+
+    # ...otherwise compare the bytes directly, stopping at the first difference
+    debug("Compare %s <-> %s..." % (pathA, pathB))
+    with open(pathA, "rb") as fileA, open(pathB, "rb") as fileB:
+        while True:
+            blockA = fileA.read(SHA256_READ_CHUNK_SIZE)
+            blockB = fileB.read(SHA256_READ_CHUNK_SIZE)
+            if blockA != blockB:
+                return False
+            if not blockA:
+                return True
+
+
 def sha256(path):
+    import hashlib
+
+    # Reuse the digest of a file that hasn't changed since it was last hashed during this run
+    global gSha256Cache
+    st = os.stat(path)
+    cacheKey = sha256CacheKey(path, st)
+    if cacheKey in gSha256Cache:
+        debug("SHA256 %s (cached) %s" % (path, gSha256Cache[cacheKey].hex()))
+        return gSha256Cache[cacheKey]
+
     debug("SHA256 %s..." % path)
-    hasher = hashlib.sha256()
-    with open(path,"rb") as f:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: f.read(SHA256_READ_CHUNK_SIZE),b""):
-            hasher.update(byte_block)
-        sha256 = hasher.hexdigest()
-    debug("... %s" % sha256)
+    with open(path,"rb",buffering=0) as f:
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+: let hashlib drive the read loop in C
+            sha256 = hashlib.file_digest(f, "sha256").digest()
+        else:
+            hasher = hashlib.sha256()
+            # Hash large files in a single update over a memory map of the whole file, if possible
+            mappedFile = None
+            if st.st_size >= SHA256_READ_CHUNK_SIZE:
+                try:
+                    mappedFile = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    pass
+            if mappedFile is not None:
+                with mappedFile:
+                    hasher.update(mappedFile)
+            else:
+                # Read and update hash string value in blocks of SHA256_READ_CHUNK_SIZE, reusing a single buffer
+                buffer = bytearray(SHA256_READ_CHUNK_SIZE)
+                bufferView = memoryview(buffer)
+                while (bytesRead := f.readinto(buffer)):
+                    hasher.update(bufferView[:bytesRead])
+            sha256 = hasher.digest()
+    debug("... %s" % sha256.hex())
+    gSha256Cache[cacheKey] = sha256
     return sha256
 
 
 def isIPv4(ip: str) -> bool:
+    import socket
+
     try:
-        return True if type(ip_address(ip)) is IPv4Address else False
-    except ValueError:
+        socket.inet_pton(socket.AF_INET, ip)
+        return True
+    except (OSError, ValueError):   # ValueError for embedded NUL characters
         return False
 
 
 def isMAC(mac: str) -> bool:
-    return re.match("[0-9a-f]{2}([-:]?)[0-9a-f]{2}(\\1[0-9a-f]{2}){4}$", mac.lower())
+    return MAC_ADDRESS_PATTERN.match(mac.lower()) is not None
 
 
 def isDomainName(domain: str) -> bool:
-    pattern = re.compile(
-        r'^(([a-zA-Z]{1})|([a-zA-Z]{1}[a-zA-Z]{1})|'
-        r'([a-zA-Z]{1}[0-9]{1})|([0-9]{1}[a-zA-Z]{1})|'
-        r'([a-zA-Z0-9][-_.a-zA-Z0-9]{0,61}[a-zA-Z0-9]))\.'
-        r'([a-zA-Z]{2,13}|[a-zA-Z0-9-]{2,30}.[a-zA-Z]{2,3})$'
-    )
-    return pattern.match(domain)
+    return DOMAIN_NAME_PATTERN.match(domain) is not None
+
+
+def nonCommentLines(lines):
+    # skip empty lines and comments
+    for line in lines:
+        stripped_line = line.strip()
+        if len(stripped_line) > 0 and not stripped_line.startswith(CSV_COMMENT_START):
+            yield stripped_line
 
 
 def loadCSV(relpath):
@@ -233,61 +342,61 @@ def loadCSV(relpath):
     if not os.path.isfile(relpath):
         error("No file found at %s" % relpath)
     
-    if relpath in gCsvCache:
-        csvAsListOfDicts = gCsvCache[relpath]
-    else:
-        # skip empty lines and comments
-        validCSV = list()
-        with open(relpath) as rawfile:
-            for line in rawfile:
-                stripped_line = line.strip()
-                if len(stripped_line) > 0 and not stripped_line.startswith(CSV_COMMENT_START):
-                    validCSV.append(stripped_line)
+    with gCacheLock:
+        csvAsListOfDicts = gCsvCache.get(relpath)
+        if csvAsListOfDicts is None:
+            csvAsListOfDicts = parseCSV(relpath)
+            gCsvCache[relpath] = csvAsListOfDicts
         
-        # use CSV parser to return a list of dictionaries
-        csvAsListOfDicts = list()
-        for rawRow in csv.DictReader(validCSV):
-            # strip surrounding whitespace on keys & values
-            row = dict()
-            for k,v in rawRow.items():
-                row[k.strip()] = v.strip()
+    return csvAsListOfDicts
 
-            csvAsListOfDicts.append(row)
 
-        gCsvCache[relpath] = csvAsListOfDicts
-        
+def parseCSV(relpath):
+    # use CSV parser to return a list of dictionaries, feeding it only non-empty, non-comment lines
+    csvAsListOfDicts = list()
+    with open(relpath, newline='', buffering=CSV_READ_BUFFER_SIZE) as rawfile:
+        reader = csv.reader(nonCommentLines(rawfile))
+        # strip surrounding whitespace on keys (once) & values; intern keys since every row shares them
+        header = [ sys.intern(k.strip()) for k in next(reader, []) ]
+        for rawRow in reader:
+            if len(rawRow) != len(header):
+                error("Row %r in '%s' has %i fields; expected %i" % (rawRow, relpath, len(rawRow), len(header)))
+            csvAsListOfDicts.append(dict(zip(header, (v.strip() for v in rawRow))))
     return csvAsListOfDicts
 
 
 def loadJSON(path):
     jsonDict = None
-    with open(path, "r") as jsonFile:
-        jsonDict = json.load(jsonFile)
+    with open(path, "rb") as jsonFile:
+        jsonDict = jsonLoads(jsonFile.read())
     jsonDict.pop(JSON_COMMENT_KEY, None) # remove comment keys, if any
     return jsonDict 
 
 
 def openBSDVersion(hostdef):
+    global gOpenBsdVersionByFlavor
+    flavor = hostdef[HOSTMAP_FIELD_OSFLAVOR]
+    if flavor in gOpenBsdVersionByFlavor:
+        return gOpenBsdVersionByFlavor[flavor]
+
     openBSDVersionForHost = None
     global gLatestOpenBsdStableVersion
     if gLatestOpenBsdStableVersion == None:
         if not os.path.isfile(OPENBSD_VERSION_FILENAME):
             error("Missing OpenBSD release version file '%s'" % OPENBSD_VERSION_FILENAME)
 
-        pattern = re.compile("\d{2,3}")
         try:
             with open(OPENBSD_VERSION_FILENAME) as f:
                 releaseText = f.read()
         except:
             error("Can't read OpenBSD version file '%s': %s" % (OPENBSD_VERSION_FILENAME, sys.exc_info()))
 
-        if not len(releaseText) == 2 or pattern.fullmatch(releaseText) == None:
+        if not len(releaseText) == 2 or OPENBSD_VERSION_PATTERN.fullmatch(releaseText) is None:
             error("OpenBSD version file '%s' must be in NN format" % OPENBSD_VERSION_FILENAME)
         gLatestOpenBsdStableVersion = releaseText
     
     # 'Stable' OS flavor uses last released version number
     # 'Current' OS flavor uses last released version number + 1
-    flavor = hostdef[HOSTMAP_FIELD_OSFLAVOR]
     if flavor == OSFLAVOR_STABLE:
         openBSDVersionForHost = gLatestOpenBsdStableVersion
     elif flavor == OSFLAVOR_CURRENT:
@@ -295,6 +404,7 @@ def openBSDVersion(hostdef):
     else:
         error("Unknown OpenBSD flavor '%s'" % flavor)
     
+    gOpenBsdVersionByFlavor[flavor] = openBSDVersionForHost
     return openBSDVersionForHost
 
     
@@ -302,47 +412,109 @@ def dottedVersion(undottedVersionString):
     return undottedVersionString[0] + '.' + undottedVersionString[1]
 
 
+@functools.lru_cache(maxsize=1)
+def darwinClonefile():
+    import ctypes
+    
+    libSystem = ctypes.CDLL("/usr/lib/libSystem.B.dylib", use_errno=True)
+    clonefile = libSystem.clonefile
+    clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32]
+    clonefile.restype = ctypes.c_int
+    return clonefile
+
+
+def cloneFile(srcPath, dstPath):
+    # Try a copy-on-write clone (APFS clonefile()).
+    # Returns False if the platform or filesystem can't do it, in which case the caller should do a regular copy.
+    if sys.platform == "darwin":
+        try:
+            clonefile = darwinClonefile()
+        except (OSError, AttributeError):
+            return False
+        # clonefile() refuses to replace an existing destination
+        if os.path.lexists(dstPath):
+            os.unlink(dstPath)
+        return clonefile(os.fsencode(srcPath), os.fsencode(dstPath), 0) == 0
+
+    return False
+
+
+def copyFile(srcPath, dstPath):
+    # Copy file contents with the cheapest mechanism the platform and filesystem offer
+    import shutil
+
+    if cloneFile(srcPath, dstPath):
+        return
+    if sys.platform == "darwin":
+        # shutil uses the kernel's fcopyfile() here
+        shutil.copyfile(srcPath, dstPath)
+    else:
+        # elsewhere (e.g. OpenBSD) shutil falls back to a 64KB read/write loop, so use larger blocks
+        with open(srcPath, "rb") as srcFile, open(dstPath, "wb") as dstFile:
+            shutil.copyfileobj(srcFile, dstFile, FILE_COPY_CHUNK_SIZE)
+
+
 def copyFileIfNeeded(srcPath, dstPath):
     needsCopy = True
+    needsTimestamp = True
 
-    if os.path.isfile(dstPath):
-        if os.path.getsize(srcPath) == os.path.getsize(dstPath):
-            if sha256(srcPath) == sha256(dstPath):
+    srcStat = os.stat(srcPath)
+    try:
+        dstStat = os.stat(dstPath)
+    except FileNotFoundError:
+        dstStat = None
+    if dstStat is not None and stat.S_ISREG(dstStat.st_mode):
+        if (srcStat.st_dev, srcStat.st_ino) == (dstStat.st_dev, dstStat.st_ino):
+            # same file
+            needsCopy = False
+            needsTimestamp = False
+        elif srcStat.st_size == dstStat.st_size:
+            if srcStat.st_mtime_ns == dstStat.st_mtime_ns:
+                # previous copies are stamped with the source's modification time, so an
+                # identical size and timestamp means the source hasn't changed since
+                needsCopy = False
+                needsTimestamp = False
+            elif filesHaveSameContents(srcPath, dstPath):
                 needsCopy = False
 
     debug("Copy %s -> %s" % (srcPath, dstPath))            
     if needsCopy:
-        shutil.copyfile(srcPath, dstPath)
+        copyFile(srcPath, dstPath)
     else:
         debug("  (Skipping)")
+    if needsTimestamp:
+        os.utime(dstPath, ns=(srcStat.st_atime_ns, srcStat.st_mtime_ns))
 
 
 def getHostDefinition(hostname):    
     # find host in hostmap
-    global gHostMap
-    for hostdef in gHostMap:
-        if hostdef[HOSTMAP_FIELD_HOSTNAME] == hostname:
-            return hostdef
-    return None
+    global gHostMapByName
+    return gHostMapByName.get(hostname)
     
 
 def getBoardConfiguration(boardname):
     global gBoardmap
     if gBoardmap is None:
-        gBoardmap = dict()
-        boardmapList = loadCSV(BOARDMAP_FILENAME)
-        for boardEntry in boardmapList:
-            boardName = boardEntry[BOARDMAP_FIELD_BOARDNAME]
-            if boardName in gBoardmap:
-                error("Board name '%s' has multiple entries in '%s'." % ( boardName, BOARDMAP_FILENAME))
-            
-            # Add image flash options fron board/_FLASHOPTIONS.json, if present
-            flashOptionsFilePath = os.path.join(os.path.join(DOMAIN_BOARD, boardName), FLASHOPTIONS_FILENAME)
-            if os.path.isfile(flashOptionsFilePath):
-                with open(flashOptionsFilePath, "r") as flashOptionsFile:
-                    boardEntry[BOARDMAP_FIELD_FLASH_OPTIONS] = json.load(flashOptionsFile)
-
-            gBoardmap[boardName] = boardEntry
+        with gCacheLock:
+            if gBoardmap is None:
+                # build the complete map before publishing it so that other threads never see a partial one
+                boardmap = dict()
+                boardmapList = loadCSV(BOARDMAP_FILENAME)
+                for boardEntry in boardmapList:
+                    boardName = boardEntry[BOARDMAP_FIELD_BOARDNAME]
+                    if boardName in boardmap:
+                        error("Board name '%s' has multiple entries in '%s'." % ( boardName, BOARDMAP_FILENAME))
+                    
+                    # Add image flash options fron board/_FLASHOPTIONS.json, if present
+                    flashOptionsFilePath = os.path.join(os.path.join(DOMAIN_BOARD, boardName), FLASHOPTIONS_FILENAME)
+                    if os.path.isfile(flashOptionsFilePath):
+                        boardEntry[BOARDMAP_FIELD_FLASH_OPTIONS] = loadJSON(flashOptionsFilePath)
+                        if boardEntry[BOARDMAP_FIELD_FLASH_OPTIONS]:
+                            # tolerate a file without 'images' here; this runs for every board in every tool
+                            boardEntry[BOARDMAP_FIELD_FLASH_IMAGE_OPTIONS] = boardEntry[BOARDMAP_FIELD_FLASH_OPTIONS].get('images')
+
+                    boardmap[boardName] = boardEntry
+                gBoardmap = boardmap
 
     return gBoardmap[boardname]
 
@@ -364,25 +536,19 @@ def installImageNameInfixForBoard(boardname):
 
 
 def installImageFlashOptionsForBoard(boardname):
-    installImageFlashOptions = None
-    flashOptions = getBoardConfiguration(boardname).get(BOARDMAP_FIELD_FLASH_OPTIONS, None)
-    if flashOptions:
-        installImageFlashOptions = flashOptions['images']
-    return installImageFlashOptions
+    return getBoardConfiguration(boardname).get(BOARDMAP_FIELD_FLASH_IMAGE_OPTIONS, None)
 
 
 def rootRelativePathForDomainResource(domain, hostdef, domainRelativePath):
     # strip a leading / so that os.path.join() doesn't incorrectly discard preceding path components
     if domainRelativePath.startswith('/'):
         domainRelativePath = domainRelativePath[1:]
-    domainPathMapping = {
-        DOMAIN_COMMON : os.path.join(DOMAIN_COMMON, domainRelativePath),
-        DOMAIN_REALM  : os.path.join(DOMAIN_REALM,  hostdef[HOSTMAP_FIELD_REALM], domainRelativePath),
-        DOMAIN_ROLE   : os.path.join(DOMAIN_ROLE,   hostdef[HOSTMAP_FIELD_ROLE], domainRelativePath),
-        DOMAIN_BOARD  : os.path.join(DOMAIN_BOARD,  hostdef[HOSTMAP_FIELD_BOARD], domainRelativePath),
-        DOMAIN_HOST   : os.path.join(DOMAIN_HOST,   hostdef[HOSTMAP_FIELD_HOSTNAME], domainRelativePath),
-    }
-    return domainPathMapping.get(domain, None)
+    if domain == DOMAIN_COMMON:
+        return os.path.join(DOMAIN_COMMON, domainRelativePath)
+    hostdefField = DOMAIN_HOSTMAP_FIELDS.get(domain, None)
+    if hostdefField is None:
+        return None
+    return os.path.join(domain, hostdef[hostdefField], domainRelativePath)
 
 
 def printHostConfigurationForDefinition(hostdef):
@@ -403,17 +569,18 @@ def configValue(key):
     return gConfig.get(key)
 
 
-def locateConfigDirectory():    
+def locateConfigDirectory(userArgs):    
     # Determine where the oort-config directory lives. The path can be specified in several ways.
     # Check in order of precedence:
     # 1. The -c / --config-dir command line argument
     # 2. The OORTCONFIGDIR environment variable
     # 3. An .oortconfigpath file in user's home directory, containing the path to oort-config
     # 4. An .oortconfig directory existing in the user's home directory containing the actual configuration
-    debug("All CLI args: %r" % OortArgs().getArgs())
+    debug("All CLI args: %r" % userArgs)
+    homeDirPath = os.path.expanduser("~")
 
     # 1. The -c / --config-dir command line argument
-    configDirPath = OortArgs().get('config_dir')
+    configDirPath = getattr(userArgs, 'config_dir', None)
     debug("configDirPath = %r" % configDirPath)
     if configDirPath is not None:
         configDirPath = os.path.expanduser(configDirPath)
@@ -428,7 +595,7 @@ def locateConfigDirectory():
         return configDirPath
         
     # 3. An .oortconfigpath file in user's home directory, containing the path to oort-config
-    configDirPathAlias = os.path.expanduser(os.path.join("~", CONFIG_DIR_ALIAS_FILENAME))
+    configDirPathAlias = os.path.join(homeDirPath, CONFIG_DIR_ALIAS_FILENAME)
     if os.path.isfile(configDirPathAlias):
         with open(configDirPathAlias, "r") as configDirPathAliasFile:
             configDirPath = configDirPathAliasFile.read().strip()
@@ -437,14 +604,16 @@ def locateConfigDirectory():
         return configDirPath
     
     # 4. An .oortconfig directory existing in the user's home directory containing the actual configuration
-    configDirPath = os.path.expanduser(os.path.join("~", CONFIG_DIR_DOT_DIRNAME))
+    configDirPath = os.path.join(homeDirPath, CONFIG_DIR_DOT_DIRNAME)
     if os.path.isdir(configDirPath):
         return configDirPath
     
     return None
 
 
-def readConfigFile():
+def readConfigFile(userArgs):
+    import socket
+
     global gConfig
     
     # Read global config file
@@ -452,7 +621,7 @@ def readConfigFile():
     configFilePath = os.path.abspath(configFilename)
     debug("Reading global config file %s" % configFilePath)
     assert os.path.isfile(configFilename), "No readable configuration file at " + configFilePath
-    gConfig = loadJSON(configFilename)
+    globalConfig = loadJSON(configFilename)
     
     # Read host-local config file, if present
     localConfig = dict()
@@ -464,9 +633,9 @@ def readConfigFile():
         debug("Reading local config file %s" % os.path.abspath(configFilename))
         localConfig = loadJSON(configFilename)
 
-    # Merge configs
-    gConfig = gConfig | localConfig
-    debug("Merged config: %r" % gConfig)
+    # Merge configs: settings derived below take precedence over the local config, which overrides the global config
+    gConfig = ChainMap(dict(), localConfig, globalConfig)
+    debug("Merged config: %r" % dict(gConfig))
 
     #
     # Set other global settings from config file
@@ -477,7 +646,7 @@ def readConfigFile():
     
     ### Build root path
     # Can be specified in config file(s) and/or overridden by -b / --build-dir command line argument
-    buildRootPath = OortArgs().get('build_dir') or gConfig.get(CONFIG_KEY_BUILD_ROOT_PATH)
+    buildRootPath = getattr(userArgs, 'build_dir', None) or gConfig.get(CONFIG_KEY_BUILD_ROOT_PATH)
     assert buildRootPath is not None, "You must specify a build products directory via the -b / --build-dir argument or in the OORT configuration file ('build-dir' key)"
     buildRootPath = os.path.expanduser(buildRootPath)
     gConfig[CONFIG_KEY_BUILD_ROOT_PATH] = buildRootPath
@@ -498,25 +667,38 @@ def validateHostmap():
         board = d[HOSTMAP_FIELD_BOARD]
         ip = d[HOSTMAP_FIELD_ADMIN_IP]
         mac = d[HOSTMAP_FIELD_MACADDR]
-        assert(len(hostname) > 0 and not containsWhitespace(hostname))
-        assert(   len(realm) > 0 and not containsWhitespace(realm))
-        assert(    len(role) > 0 and not containsWhitespace(role))
-        assert(  len(flavor) > 0 and not containsWhitespace(flavor))
-        assert(      len(ip) > 0 and not containsWhitespace(ip) and isIPv4(ip))
-        assert(     len(mac) > 0 and not containsWhitespace(mac) and isMAC(mac))
+        assert(TOKEN_PATTERN.fullmatch(hostname))
+        assert(   TOKEN_PATTERN.fullmatch(realm))
+        assert(    TOKEN_PATTERN.fullmatch(role))
+        assert(  TOKEN_PATTERN.fullmatch(flavor))
+        assert(      TOKEN_PATTERN.fullmatch(ip) and isIPv4(ip))
+        assert(     TOKEN_PATTERN.fullmatch(mac) and isMAC(mac))
+
+
+def loadJSONIfPresent(path):
+    return loadJSON(path) if os.path.isfile(path) else None
 
 
 def loadHostOptions():
-    for host in gHostMap:
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Most options files (common, realm, role, board) are shared by many hosts, so check for
+    # and load each distinct file only once, overlapping the file system latency across threads
+    hostOptionsFilepaths = [ [ rootRelativePathForDomainResource(domain, host, HOSTOPTIONS_FILENAME) for domain in DOMAINS ] for host in gHostMap ]
+    distinctFilepaths = list(dict.fromkeys(path for paths in hostOptionsFilepaths for path in paths))
+    with ThreadPoolExecutor(max_workers=max(1, min(HOSTOPTIONS_LOADER_THREADS, len(distinctFilepaths)))) as executor:
+        optionsByPath = dict(zip(distinctFilepaths, executor.map(loadJSONIfPresent, distinctFilepaths)))
+
+    # Merge in domain override order
+    for host, paths in zip(gHostMap, hostOptionsFilepaths):
         host[HOSTMAP_FIELD_OPTIONS_DICT] = dict()
-        for domain in DOMAINS:
-            hostOptionsFilepath = rootRelativePathForDomainResource(domain, host, HOSTOPTIONS_FILENAME)
-            if os.path.isfile(hostOptionsFilepath):
-                host[HOSTMAP_FIELD_OPTIONS_DICT].update(loadJSON(hostOptionsFilepath))
+        for hostOptionsFilepath in paths:
+            if optionsByPath[hostOptionsFilepath] is not None:
+                host[HOSTMAP_FIELD_OPTIONS_DICT].update(optionsByPath[hostOptionsFilepath])
 
 
 def hostOptionsValue(hostname, key, defaultValue = None):
-    return next((host for host in gHostMap if host[HOSTMAP_FIELD_HOSTNAME] == hostname), dict()).get(HOSTMAP_FIELD_OPTIONS_DICT, dict()).get(key, defaultValue)
+    return gHostMapByName.get(hostname, dict()).get(HOSTMAP_FIELD_OPTIONS_DICT, dict()).get(key, defaultValue)
 
 
 def getOperationalModeFromParsedArgs(args: dict):
@@ -529,39 +711,135 @@ def getOperationalModeFromParsedArgs(args: dict):
 def listHostsAndExit():
     print("Available hosts:")
     
-    for host in sorted(gHostMap, key=lambda x: x[HOSTMAP_FIELD_HOSTNAME]):
-        if host[HOSTMAP_FIELD_ROLE] != HOST_ROLE_VIRTUAL:
-            print("    %s" % host[HOSTMAP_FIELD_HOSTNAME])
+    hostnames = sorted(host[HOSTMAP_FIELD_HOSTNAME] for host in gHostMap if host[HOSTMAP_FIELD_ROLE] != HOST_ROLE_VIRTUAL)
+    if hostnames:
+        print("\n".join("    %s" % hostname for hostname in hostnames))
     
     exit()
 
 
-def OortInit(argParser: OortArgs):
-    assert not platform.system() == 'Windows', "OORT is unsafe to run on Windows"
-
-    assertNotRootUser()
-
-    # Identify what OS we are running on and initialize the OS-specific layer
-    machdepInit()
-    
+def loadConfiguration(userOptions):
     # Find the oort-config directory
-    configDirPath = locateConfigDirectory()
+    configDirPath = locateConfigDirectory(userOptions)
     assert configDirPath and os.path.isdir(configDirPath), "A valid oort-config directory could not be found. You must specify its absolute path via the -c/--config-dir argument, the " + CONFIG_DIR_ENV_VAR_NAME + " environment variable, or the ~/" + CONFIG_DIR_ALIAS_FILENAME + " file, or by storing your configuration in the ~/" + CONFIG_DIR_DOT_DIRNAME + " directory."
 
     # Change current directory to oort-config directory
     os.chdir(configDirPath)
 
     # Get user-configurable settings
-    readConfigFile()
+    readConfigFile(userOptions)
 
     # Load host definitions
     print("Loading host definitions...")
     global gHostMap
+    global gHostMapByName
     gHostMap = loadCSV(HOSTMAP_FILENAME)
+    gHostMapByName = dict()
+    for hostdef in gHostMap:
+        gHostMapByName.setdefault(hostdef[HOSTMAP_FIELD_HOSTNAME], hostdef) # first entry wins
     validateHostmap()
     loadHostOptions()
+
+
+def initHostWorker(userOptions):
+    # Worker processes don't share the parent's state (and are spawned rather than forked on macOS),
+    # so load the configuration again. The parent has already announced it, so keep quiet about it.
+    import contextlib
+    import io
+
+    machdepInit()
+    with contextlib.redirect_stdout(io.StringIO()):
+        loadConfiguration(userOptions)
+
+
+def runHostWorkerTask(hostFunction, hostname):
+    # Capture the task's output so that the parent can print it in one piece rather than interleaved with other hosts.
+    # Returns (output, exception or None); the traceback of a failure is included in the output.
+    import contextlib
+    import io
+    import traceback
+
+    output = io.StringIO()
+    failure = None
+    with contextlib.redirect_stdout(output):
+        try:
+            hostFunction(hostname)
+        except Exception as e:
+            traceback.print_exc(file=output)
+            failure = e
+    return (output.getvalue(), failure)
+
+
+def prefixedHostOutput(hostname, output):
+    # Prefix each line with the hostname, keeping only the final state of lines redrawn with carriage returns (progress meters)
+    lines = output.split("\n") # not splitlines(), which would also split at the carriage returns
+    if lines[-1] == "":
+        lines.pop()
+    return "".join("[%s] %s\n" % (hostname, line.rsplit("\r", 1)[-1]) for line in lines)
+
+
+def runForEachHost(hostFunction, hostnames, userOptions):
+    # Hosts are independent, so process several of them at once in worker processes.
+    # Returns the number of hosts processed.
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    import copy
+    import itertools
+
+    if len(hostnames) <= 1:
+        for hostname in hostnames:
+            hostFunction(hostname)
+        return len(hostnames)
+
+    # Workers load the configuration themselves, from wherever the parent found it (it has since chdir()ed there)
+    workerOptions = copy.copy(userOptions)
+    workerOptions.config_dir = os.getcwd()
+
+    completedCount = 0
+    firstFailure = None
+    workerCount = min(len(hostnames), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workerCount, initializer=initHostWorker, initargs=(workerOptions,)) as executor:
+        # Only hand out as many hosts as there are workers, so that nothing new starts once a host has failed
+        # (the executor would otherwise already have queued more work than it can cancel)
+        queuedHostnames = iter(hostnames)
+        runningFutures = dict()     # key: future, value: hostname
+        for hostname in itertools.islice(queuedHostnames, workerCount):
+            runningFutures[executor.submit(runHostWorkerTask, hostFunction, hostname)] = hostname
+
+        while runningFutures:
+            finishedFutures, _ = wait(runningFutures, return_when=FIRST_COMPLETED)
+            for future in finishedFutures:
+                hostname = runningFutures.pop(future)
+                output, failure = future.result()
+                sys.stdout.write(prefixedHostOutput(hostname, output))
+                sys.stdout.flush()
+                if failure is None:
+                    completedCount += 1
+                elif firstFailure is None:
+                    firstFailure = failure
+                    print("[%s] failed; not starting any more hosts, waiting for %i already running..." % (hostname, len(runningFutures)))
+                if firstFailure is None:
+                    nextHostname = next(queuedHostnames, None)
+                    if nextHostname is not None:
+                        runningFutures[executor.submit(runHostWorkerTask, hostFunction, nextHostname)] = nextHostname
+
+    if firstFailure is not None:
+        raise firstFailure
+    return completedCount
+
+
+def OortInit(argParser: OortArgs):
+    import platform
+
+    assert not platform.system() == 'Windows', "OORT is unsafe to run on Windows"
+
+    assertNotRootUser()
+
+    # Identify what OS we are running on and initialize the OS-specific layer
+    machdepInit()
     
     userOptions = argParser.getArgs()
+
+    loadConfiguration(userOptions)
     
     # Determine if we should run the tool as normal or perform another action instead
     mode = getOperationalModeFromParsedArgs(userOptions)    
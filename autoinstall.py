@@ -33,12 +33,10 @@ from masterDisks import generateMasteringImageForHostname, prepareNetbootDirecto
 
 
 # STANDARD LIBRARIES
-import argparse
-import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
 import shlex
-import shutil
-import signal
 import socket
 import stat
 import sys
@@ -50,7 +48,7 @@ import sys
 
 INDEX_FILENAME =        "index.html"
 BOOTP_LEASES_FILENAME = "bootp.leases"
-SPAWN_SCRIPT_FILENAME = "runnetboot.sh"
+SPAWN_SCRIPT_FILENAME = "runnetboot.sh" # no longer written; only removed if left over from earlier versions
 
 DNSMASQ_RELATIVE_PATH = os.path.join("machdep", "Darwin", "dnsmasq", "dnsmasq")
 
@@ -65,6 +63,16 @@ NETBOOT_DNSMASQ_EXEC_PATH =  "netboot-dnsmasq-executable"
 
 DEFAULT_DOMAIN_NAME =        "unspecified.domain"
 
+SET_PACKAGE_COPY_THREADS =   4
+
+
+#
+# METHODS
+#
+@functools.lru_cache(maxsize=1)
+def networkInterfaceNames():
+    return frozenset(name for index, name in socket.if_nameindex())
+
 
 #
 # CLASSES
@@ -89,7 +97,7 @@ class OpenBsdAutoInstaller:
         
         s[CONFIG_KEY_NETBOOT_INTERFACE] = configValue(CONFIG_KEY_NETBOOT_INTERFACE)
         assert s[CONFIG_KEY_NETBOOT_INTERFACE] is not None, "Configuration file %s is missing host network interface name for netboot (key: '%s')" % (configFilePath, CONFIG_KEY_NETBOOT_INTERFACE)
-        assert any(s[CONFIG_KEY_NETBOOT_INTERFACE] in iface for iface in socket.if_nameindex()), "Network interface '%s' is not attached to the system. You may need to update your configuration file if the netboot interface has changed. (key: '%s')" % (s[CONFIG_KEY_NETBOOT_INTERFACE], CONFIG_KEY_NETBOOT_INTERFACE)  # make sure the specified network interface is found on the system
+        assert s[CONFIG_KEY_NETBOOT_INTERFACE] in networkInterfaceNames(), "Network interface '%s' is not attached to the system. You may need to update your configuration file if the netboot interface has changed. (key: '%s')" % (s[CONFIG_KEY_NETBOOT_INTERFACE], CONFIG_KEY_NETBOOT_INTERFACE)  # make sure the specified network interface is found on the system
 
         s[CONFIG_KEY_NETBOOT_HOST_IP] = configValue(CONFIG_KEY_NETBOOT_HOST_IP)
         assert s[CONFIG_KEY_NETBOOT_HOST_IP] is not None and isIPv4(s[CONFIG_KEY_NETBOOT_HOST_IP]), "Configuration file %s has missing or invalid netboot host IP (key: '%s')" % (configFilePath, CONFIG_KEY_NETBOOT_HOST_IP)
@@ -116,32 +124,35 @@ class OpenBsdAutoInstaller:
         diskManifests = generateMasteringImageForHostname(hostname)
         setsManifest = diskManifests['sets_disk']
         
-        # Create the netboot directory structure
-        netbootDirectories = prepareNetbootDirectories(hostdef, configValue(CONFIG_KEY_BUILD_ROOT_PATH))
-        netbootHostDirectory = os.path.abspath(netbootDirectories['netboot_host'])
+        # Create the netboot directory structure; every path in it is derived from the build root, so making that
+        # absolute once makes them all absolute
+        netbootDirectories = prepareNetbootDirectories(hostdef, os.path.abspath(configValue(CONFIG_KEY_BUILD_ROOT_PATH)))
+        netbootHostDirectory = netbootDirectories['netboot_host']
         
         # Update our settings
-        self.s[NETBOOT_FSROOT] = os.path.abspath(netbootDirectories['netboot_root'])
-        self.s[NETBOOT_RUNTIME] = os.path.abspath(netbootDirectories['netboot_runtime'])
-        self.s[NETBOOT_DNSMASQ_EXEC_PATH] = os.path.join(configValue(CONFIG_KEY_EXECUTABLES_PATH), DNSMASQ_RELATIVE_PATH)
-        self.s[NETBOOT_LEASES_FILE] = os.path.join(self.s[NETBOOT_RUNTIME], BOOTP_LEASES_FILENAME)
-        self.s[NETBOOT_APACHE_CONFIG_FILE] = os.path.abspath(os.path.join(configValue(CONFIG_KEY_EXECUTABLES_PATH), MACHDEP_DIRNAME, machdep_platform(), NETBOOT_APACHE_CONFIG_FILENAME))
-        self.s[NETBOOT_APACHE_PID_FILE] = os.path.join(self.s[NETBOOT_RUNTIME], NETBOOT_APACHE_PID_FILENAME)
-        self.s[NETBOOT_APACHE_ERROR_FILE] = os.path.join(self.s[NETBOOT_RUNTIME], NETBOOT_APACHE_ERROR_LOG_FILENAME)
-        self.s[NETBOOT_APACHE_ACCESS_FILE] = os.path.join(self.s[NETBOOT_RUNTIME], NETBOOT_APACHE_ACCESS_LOG_FILENAME)
+        execPath = configValue(CONFIG_KEY_EXECUTABLES_PATH) # already absolute
+        self.s[NETBOOT_FSROOT] = netbootDirectories['netboot_root']
+        runtimeDirectory = netbootDirectories['netboot_runtime']
+        self.s[NETBOOT_RUNTIME] = runtimeDirectory
+        self.s[NETBOOT_DNSMASQ_EXEC_PATH] = os.path.join(execPath, DNSMASQ_RELATIVE_PATH)
+        self.s[NETBOOT_LEASES_FILE] = os.path.join(runtimeDirectory, BOOTP_LEASES_FILENAME)
+        self.s[NETBOOT_APACHE_CONFIG_FILE] = os.path.join(execPath, MACHDEP_DIRNAME, machdep_platform(), NETBOOT_APACHE_CONFIG_FILENAME)
+        self.s[NETBOOT_APACHE_PID_FILE] = os.path.join(runtimeDirectory, NETBOOT_APACHE_PID_FILENAME)
+        self.s[NETBOOT_APACHE_ERROR_FILE] = os.path.join(runtimeDirectory, NETBOOT_APACHE_ERROR_LOG_FILENAME)
+        self.s[NETBOOT_APACHE_ACCESS_FILE] = os.path.join(runtimeDirectory, NETBOOT_APACHE_ACCESS_LOG_FILENAME)
         
-        # Copy set packages from staging
+        # Copy set packages from staging; the copies are independent, so overlap them
         print("Copying set packages...")
-        for setManifestEntry in setsManifest:
-            src = setManifestEntry['abspath']
-            dst = os.path.join(netbootHostDirectory, setManifestEntry['filename'])
-            copyFileIfNeeded(src, dst)
+        with ThreadPoolExecutor(max_workers=SET_PACKAGE_COPY_THREADS) as executor:
+            copies = [ executor.submit(copyFileIfNeeded, setManifestEntry['abspath'], os.path.join(netbootHostDirectory, setManifestEntry['filename'])) for setManifestEntry in setsManifest ]
+            for copy in copies:
+                copy.result() # re-raise any copy failure
 
         # Create an index.html file to identify the name of this host
         print("Writing %s..." % INDEX_FILENAME)
         indexFilePath = os.path.join(netbootHostDirectory, INDEX_FILENAME)
-        with open(indexFilePath, 'w') as indexFile:
-            indexFile.write(hostname)
+        with open(indexFilePath, 'wb') as indexFile:
+            indexFile.write(hostname.encode())
     
         # Create empty Apache logs and bootp lease files as current user so that the sudo'd processes don't create them as root
         blankFilePaths = [
@@ -151,19 +162,22 @@ class OpenBsdAutoInstaller:
         ]
         for fp in blankFilePaths:
             print("Writing %s..." % fp)
-            with open(fp, 'w') as blankFile:
-                blankFile.write('')
+            os.close(os.open(fp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
 
 
     def spawnServerSubtasks(self):
         dnsmasqPath = self.s[NETBOOT_DNSMASQ_EXEC_PATH]
         assert os.path.isfile(dnsmasqPath), "Missing Dnsmasq executable expected at %s" % dnsmasqPath
+        dnsmasqFilename = os.path.basename(dnsmasqPath)
+        runtimeDirectory = self.s[NETBOOT_RUNTIME] # absolute; see populateNetbootDirectory()
 
         hostname = self.hostdef[HOSTMAP_FIELD_HOSTNAME]
+        # servers drop privileges to the invoking user
+        serverUser = os.getlogin()
 
         # Build command invocations for BOOTP and HTTP servers
         bootpServerCmd = shlex.join([
-            "./" + os.path.basename(dnsmasqPath),
+            "./" + dnsmasqFilename,
             "--keep-in-foreground",
             "--interface=" + self.s[CONFIG_KEY_NETBOOT_INTERFACE],
             "--no-hosts",
@@ -175,24 +189,24 @@ class OpenBsdAutoInstaller:
             "--dhcp-host=" + self.s[CONFIG_KEY_NETBOOT_TARGET_MAC] + ',' + self.s[CONFIG_KEY_NETBOOT_TARGET_IP] + ',' + hostname + ',infinite',
             "--dhcp-boot=" + hostname + "/auto_install," + self.s[CONFIG_KEY_NETBOOT_HOST_IP],
             "--dhcp-option=option:domain-name," + self.s[HOSTOPTIONS_KEY_DOMAIN_NAME],
-            "--user=" + os.getlogin()
+            "--user=" + serverUser
         ])
         httpServerCmd = shlex.join([
             "httpd",
             "-X", # keep in foreground
-            "-d", self.s[NETBOOT_RUNTIME],
+            "-d", runtimeDirectory,
             "-f", self.s[NETBOOT_APACHE_CONFIG_FILE],
             "-E", self.s[NETBOOT_APACHE_ERROR_FILE],
             "-c", "PidFile " + self.s[NETBOOT_APACHE_PID_FILE],
             "-c", "ErrorLog " + self.s[NETBOOT_APACHE_ERROR_FILE],
             "-c", "CustomLog " + self.s[NETBOOT_APACHE_ACCESS_FILE] + " stdlogformat",
             "-c", "ServerName " + self.s[CONFIG_KEY_NETBOOT_HOST_IP],
-            "-c", "User " + os.getlogin(),
+            "-c", "User " + serverUser,
             "-c", "DocumentRoot " + self.s[NETBOOT_FSROOT],
         ])
         
         # Create a master spawning-reaping script file to manage the server subtasks
-        varSubs = { "$NETBOOT_RUNTIME_DIR": os.path.abspath(self.s[NETBOOT_RUNTIME]),
+        varSubs = { "$NETBOOT_RUNTIME_DIR": runtimeDirectory,
                     "$BOOTP_SERVER_CMD": bootpServerCmd,
                     "$HTTP_SERVER_CMD": httpServerCmd}
         spawnScript = replaceVariablesInString(
@@ -209,20 +223,48 @@ class OpenBsdAutoInstaller:
 exitCode=1
 
 cleanup () {
-    kill -TERM $PID1 $PID2 2> /dev/null
+    kill -TERM $PID1 $PID2 $PID3 2> /dev/null
     exit $exitCode
 }
 
+# Each server runs under a watcher subshell that signals this script with USR1 if the server exits,
+# and [ENTER] is read in the background and signalled with USR2, so that the script can simply block
+# in 'wait' rather than polling. (/bin/sh is not guaranteed to support 'wait -n'.)
+trap "exitCode=0; cleanup" INT
+trap "cleanup" TERM EXIT
+trap "exitCode=1; cleanup" USR1
+trap 'echo "Cleaning up..."; exitCode=0; cleanup' USR2
+
 cd "$NETBOOT_RUNTIME_DIR"
 
 echo "Starting BOOTP server..."
-$BOOTP_SERVER_CMD &
+(
+    trap 'kill -TERM $child 2> /dev/null; exit' TERM
+    $BOOTP_SERVER_CMD &
+    child="$!"
+    wait $child
+    echo "dnsmasq terminated unexpectedly. Shutting down."
+    kill -USR1 $$
+) &
 PID1="$!"
 
 echo "Starting HTTP server..."
-$HTTP_SERVER_CMD &
+(
+    trap 'kill -TERM $child 2> /dev/null; exit' TERM
+    $HTTP_SERVER_CMD &
+    child="$!"
+    wait $child
+    echo "httpd terminated unexpectedly. Shutting down."
+    kill -USR1 $$
+) &
 PID2="$!"
 
+# background jobs get /dev/null as stdin unless it is explicitly redirected
+exec 3<&0
+( read dummy && kill -USR2 $$ ) <&3 &
+PID3="$!"
+exec 3<&-
+
 echo 
 echo "The autoinstall server is now running. To start a fully automated installation of OpenBSD:"
 echo 
@@ -233,61 +275,30 @@ echo "    4. Wait until autoinstallation is complete and the target has rebooted
 echo
 echo "Press [ENTER] when OpenBSD has finished installing and the target has been rebooted. (Exiting early may cause the installer to hang.)"
 
-trap "exitCode=0; cleanup" INT
-trap "cleanup" TERM EXIT
-
-while true
-do
-    kill -0 $PID1 2> /dev/null
-    if [ $? -ne 0 ]; then
-        echo "dnsmasq terminated unexpectedly. Shutting down."
-        exitCode=1
-        cleanup
-    fi
-
-    kill -0 $PID2 2> /dev/null
-    if [ $? -ne 0 ]; then
-        echo "httpd terminated unexpectedly. Shutting down."
-        exitCode=1
-        cleanup
-    fi
-
-    read -t 1 dummy
-    if [ $? -eq 0 ]; then
-        echo "Cleaning up..."
-        exitCode=0
-        cleanup
-    fi
-done
+wait
+cleanup
 
 ''', varSubs)
 
         userRXMode = stat.S_IRUSR | stat.S_IXUSR
         
-        spawnScriptPath = os.path.join(self.s[NETBOOT_RUNTIME], SPAWN_SCRIPT_FILENAME)
-        # delete existing file since we can't overwrite it due to previously unset write permission
-        if os.path.exists(spawnScriptPath):
-            os.remove(spawnScriptPath)
-        with open(spawnScriptPath, 'w') as spawnScriptFile:
-            spawnScriptFile.write(spawnScript)
-        os.chmod(spawnScriptPath, userRXMode)
+        # The script is run from memory (see below), so remove any copy left on disk by older versions of this tool
+        # rather than leave something behind that looks like what runs
+        staleSpawnScriptPath = os.path.join(runtimeDirectory, SPAWN_SCRIPT_FILENAME)
+        if os.path.exists(staleSpawnScriptPath):
+            os.remove(staleSpawnScriptPath)
         
         # Copy the dnsmasq binary to the local netboot runtime directory so that we can chroot() there
         src = dnsmasqPath
-        dst = os.path.join(self.s[NETBOOT_RUNTIME], os.path.basename(dnsmasqPath))
+        dst = os.path.join(runtimeDirectory, dnsmasqFilename)
         copyFileIfNeeded(src, dst)
         os.chmod(dst, userRXMode)
         
-        # Re-read the script file we just wrote out just out of sheer paranoia
-        with open(spawnScriptPath, 'r') as reopenedSpawnScriptFile:
-            reopenedSpawnScript = reopenedSpawnScriptFile.read()
-        assert reopenedSpawnScript == spawnScript, "Server master spawning script has been altered. Privilege escalation aborted."
-        
         shouldSpawn = False
         print("\n\n*********************************************************************************************")
         print("*********************************************************************************************")
         print("*********************************************************************************************")
-        print(reopenedSpawnScript)
+        print(spawnScript)
         print("*********************************************************************************************")
         print("*********************************************************************************************")
         print("*********************************************************************************************")
@@ -300,7 +311,9 @@ done
         
         if shouldSpawn:
             print("Spinning up background tasks...")
-            machdep_run_command_as_superuser([ spawnScriptPath ])
+            # Run the in-memory script that was shown above rather than the file, so that nothing
+            # can alter it on disk between the user's confirmation and privilege escalation
+            machdep_run_command_as_superuser([ "/bin/sh", "-c", spawnScript ])
 
 
 def main(argv):
@@ -33,7 +33,10 @@ from OortCommon import *
 
 # STANDARD LIBRARIES
 import errno
+import functools
 import shutil
+import stat
+import subprocess
 import sys
 import tempfile
 import tarfile
@@ -59,6 +62,7 @@ PACKAGES_FILENAME =          "_PACKAGES.csv"
 PACKAGES_FIELD_NAME =        "PACKAGE"
 
 SITE_PACKAGE_NAME_TEMPLATE = "site%s-%s.tgz"  # first arg = release, second arg = host
+SITE_PACKAGE_WRITE_BUFFER_SIZE = 1024 * 1024 # write the site package archive in 1MB blocks
 INSTALL_SCRIPT_ABSPATH =     "/install.site"
 FIRSTBOOT_APPEND_ABSPATH =   "/etc/rc.firsttime"
 ETCHOSTS_ABSPATH =           "/etc/hosts"
@@ -72,20 +76,23 @@ AUTOGEN_FILENAME_PACKAGES =             "_AUTOGEN_post_install_package_list.txt"
 AUTOGEN_FILENAME_SITE_INSTALL_APPEND =  "_AUTOGEN_install.site"
 AUTOGEN_FILENAME_AUTOINSTALL =          "_AUTOGEN_" + AUTOINSTALL_FILENAME
 AUTOGEN_FILEPATTERN_AUTODISKLABEL =     "_AUTOGEN_" + AUTODISKLABEL_FILENAME_PTN
+AUTOGEN_AUTODISKLABEL_PATTERN =         re.compile(AUTOGEN_FILEPATTERN_AUTODISKLABEL)
 
 AUTOINSTALL_VAR_HOSTNAME =        "__OORT_TEMPLATE_HOSTNAME__"
 AUTOINSTALL_VAR_NETBOOT_HOST_IP = "__OORT_TEMPLATE_NETBOOT_HOST_IP__"
 AUTOINSTALL_VAR_OPENBSD_VERSION = "__OORT_TEMPLATE_OPENBSD_SHORTVERSION__"
 
 TMP_DIR_PREFIX = "network.ohsnap.oort.sitegen_"
+STALE_DIR_SUFFIX = ".old"
 
 
 #
 # GLOBAL VARIABLES
 #
 # Per-host... must be reset!
-gPermissionsMapping = dict()
+gPermissionsMapping = dict()   # key: absolute path in site root, value: (user, group, mode)
 gInstallSiteScriptAppend = ''
+gPackageListsByPath = dict()   # key: destination path of a package list file, value: package names from all domains
 
 
 #
@@ -97,7 +104,8 @@ def prepareOutputDirectories(hostname):
     finalOutputDirectoryPath = os.path.join(buildRootPath, BUILD_DIR, hostname, BUILD_DIR_DESTROOT_NAME)
     makeDirIfNeeded(finalOutputDirectoryPath)
     
-    intermediateBuildDirectoryPath = tempfile.mkdtemp(prefix=TMP_DIR_PREFIX)
+    # keep the intermediate tree next to the final one so that it can be moved into place with a rename
+    intermediateBuildDirectoryPath = tempfile.mkdtemp(prefix=TMP_DIR_PREFIX, dir=os.path.dirname(finalOutputDirectoryPath))
 
     autoinstallOutputDirectoryPath = os.path.join(buildRootPath, BUILD_DIR, hostname, AUTOINSTALL_DIR)
     makeDirIfNeeded(autoinstallOutputDirectoryPath)
@@ -129,6 +137,7 @@ def checkTemplateDirectoryStructure(hostdef):
             error("Configuration directory is missing %s manifest '%s'" % (domain, manifestPath))
 
 
+@functools.lru_cache(maxsize=4096)
 def performSubstitutionsOnPath(path):
     path = path.replace(MANIFEST_SUBSTITUTION_DOTFILE, ".")
     path = path.replace(MANIFEST_SUBSTITUTION_AUTOGEN, "")
@@ -145,14 +154,12 @@ def processAutogenFile(sourcePath, destPath, domain, hostdef):
     # /root/post_install_package_list.txt
     if sourceName == AUTOGEN_FILENAME_PACKAGES:
         packagesSourceDict = loadCSV(packagesPathForDomain(domain, hostdef))
-        packagesDestList = list()
-        for packageEntry in packagesSourceDict:
-            packagesDestList.append(packageEntry[PACKAGES_FIELD_NAME])
-
-        debug("Autogen: Write to '%s': %r" % (destPath, packagesDestList))
-        with open(destPath, 'a') as packagesTextFile:
-            for package in packagesDestList:
-                packagesTextFile.write(str(package) + '\n')
+        packagesDestList = [ packageEntry[PACKAGES_FIELD_NAME] for packageEntry in packagesSourceDict ]
+
+        # packages accumulate across domains and are written out once in writeAutogenPackageLists()
+        debug("Autogen: Append to '%s': %r" % (destPath, packagesDestList))
+        global gPackageListsByPath
+        gPackageListsByPath.setdefault(destPath, []).extend(packagesDestList)
                 
     
     # /install.site
@@ -180,11 +187,11 @@ def processAutogenFile(sourcePath, destPath, domain, hostdef):
         
 
     # autodisklabel file(s) for autoinstallation
-    elif autodisklabelNameMatch := re.match(AUTOGEN_FILEPATTERN_AUTODISKLABEL, sourceName):
+    elif autodisklabelNameMatch := AUTOGEN_AUTODISKLABEL_PATTERN.match(sourceName):
         # The autodisklabel file(s) don't actually go into the site package, so we need to manually move them up into the host output parent directory
         autodisklabelName = autodisklabelNameMatch.group(1)
         destPath = os.path.join(autoinstallConfigurationRootPathForHost(hostdef), autodisklabelName)
-        shutil.copyfile(sourcePath, destPath)
+        copyFile(sourcePath, destPath)
 
 #     else:
 #         error("'%s' is not an autogenerated file" % sourcePath)
@@ -194,21 +201,33 @@ def setArchivedFilePermissions(tarinfo):
     absPath = '/' + tarinfo.name        # the permission lookup key should be relative to absolute root since this script works in abs paths...
     tarinfo.name = './' + tarinfo.name  # ...but for OpenBSD, which chroot()s during install, path needs to be relative
 
-    tarinfo.uname = gPermissionsMapping[absPath]['user']
-    tarinfo.gname = gPermissionsMapping[absPath]['group']
-    tarinfo.mode = gPermissionsMapping[absPath]['perm']
-    debug("[tarinfo] name = %s, user = %s, group = %s, mode = %i" % (tarinfo.name, tarinfo.uname, tarinfo.gname, tarinfo.mode))
+    tarinfo.uname, tarinfo.gname, tarinfo.mode = gPermissionsMapping[absPath]
+    debug("[tarinfo] name = %s, user = %s, group = %s, mode = %i", tarinfo.name, tarinfo.uname, tarinfo.gname, tarinfo.mode)
     return tarinfo
     
     
 def makeTarFile(sourceDir, destPath):
-    with tarfile.open(destPath, "w:gz") as tar:
-        tar.add(sourceDir, arcname='/', filter=setArchivedFilePermissions)
+    pigzPath = shutil.which("pigz")
+    if pigzPath is None:
+        # stream mode writes the compressed archive out in large blocks rather than one small write per chunk
+        with tarfile.open(destPath, "w|gz", bufsize=SITE_PACKAGE_WRITE_BUFFER_SIZE) as tar:
+            tar.add(sourceDir, arcname='/', filter=setArchivedFilePermissions)
+        return
+
+    # pigz compresses on all cores, so hand it an uncompressed tar stream instead
+    debug("Compressing with %s" % pigzPath)
+    with open(destPath, "wb") as destFile:
+        with subprocess.Popen([pigzPath, "-9", "-c"], stdin=subprocess.PIPE, stdout=destFile) as pigz:
+            with tarfile.open(fileobj=pigz.stdin, mode="w|", bufsize=SITE_PACKAGE_WRITE_BUFFER_SIZE) as tar:
+                tar.add(sourceDir, arcname='/', filter=setArchivedFilePermissions)
+    if pigz.returncode != 0:
+        error("pigz failed with exit code %i while writing '%s'" % (pigz.returncode, destPath))
 
 
 def generateHostConfigurationForDomain(domain, hostdef, outputBaseDir):
     manifestPath = manifestPathForDomain(domain, hostdef)
     manifest = loadCSV(manifestPath)
+    manifestDirectoryPath = os.path.dirname(manifestPath)
     duplicatePathPrevention = set()
     for override in manifest:
         absPath = override[MANIFEST_FIELD_PATH]
@@ -220,35 +239,45 @@ def generateHostConfigurationForDomain(domain, hostdef, outputBaseDir):
             error("%s manifest contains a non-absolute path ('%s')" % (domain, absPath))
         relPath = absPath[1:]
         
-        sourcePath = os.path.join(os.path.dirname(manifestPath), relPath)
-        destPath = os.path.join(outputBaseDir, performSubstitutionsOnPath(relPath))
+        transformedRelPath = performSubstitutionsOnPath(relPath)
+        sourcePath = os.path.join(manifestDirectoryPath, relPath)
+        destPath = os.path.join(outputBaseDir, transformedRelPath)
         
         # add entry to global file permissions mapping if it doesn't already exist (i.e. first-in precedence)
         global gPermissionsMapping
-        transformedAbsPath = performSubstitutionsOnPath(absPath)
+        transformedAbsPath = "/" + transformedRelPath
         if not transformedAbsPath in gPermissionsMapping:
-            gPermissionsMapping[transformedAbsPath] = {
-                'user': override[MANIFEST_FIELD_USER],
-                'group': override[MANIFEST_FIELD_GROUP],
-                'perm': int(override[MANIFEST_FIELD_PERMISSIONS], 8),
-            }
+            gPermissionsMapping[transformedAbsPath] = (
+                override[MANIFEST_FIELD_USER],
+                override[MANIFEST_FIELD_GROUP],
+                int(override[MANIFEST_FIELD_PERMISSIONS], 8),
+            )
         
-        debug("\t\t\t\t\t%s  -->  %s" % (sourcePath, destPath))
+        debug("\t\t\t\t\t%s  -->  %s", sourcePath, destPath)
         if isAutogenFile(sourcePath):
             processAutogenFile(sourcePath, destPath, domain, hostdef)
         else:
-            if not os.path.exists(sourcePath):
+            try:
+                sourceMode = os.stat(sourcePath).st_mode
+            except FileNotFoundError:
                 error("Manifest absolute path '%s' does not correspond to an existing file or folder at '%s'" % (absPath, sourcePath))
-            if os.path.isdir(sourcePath):
+            if stat.S_ISDIR(sourceMode):
                 # dir may have already been created by previous domain - ok to skip
                 if not os.path.isdir(destPath):
                     os.mkdir(destPath)
-            elif os.path.isfile(sourcePath):
-                shutil.copyfile(sourcePath, destPath)
+            elif stat.S_ISREG(sourceMode):
+                copyFile(sourcePath, destPath)
             else:
-                error("Source path '%' is neither a file nor folder" % sourcePath)
+                error("Source path '%s' is neither a file nor folder" % sourcePath)
     
 
+def writeAutogenPackageLists():
+    for destPath, packages in gPackageListsByPath.items():
+        debug("Autogen: Write to '%s': %r" % (destPath, packages))
+        with open(destPath, 'w') as packagesTextFile:
+            packagesTextFile.write("".join(package + '\n' for package in packages))
+
+
 # Tasks:
 # - append /etc/hosts
 def generateHostInstallSiteFile(hostname, destRootPath):
@@ -302,8 +331,10 @@ def generateSitePackage(hostname):
     # clear any globals that may have gotten reused
     global gPermissionsMapping
     global gInstallSiteScriptAppend
+    global gPackageListsByPath
     gPermissionsMapping = dict()
     gInstallSiteScriptAppend = ''
+    gPackageListsByPath = dict()
 
     print("Begin generating site package set for '%s'..." % hostname)
     # Load host definition
@@ -325,25 +356,26 @@ def generateSitePackage(hostname):
         print("Generating '%s' overrides..." % domain)
         generateHostConfigurationForDomain(domain, hostdef, outputDirs['intermediate'])
         
+    writeAutogenPackageLists()
     generateHostInstallSiteFile(hostname, outputDirs['intermediate'])
 
     # move intermediate build products into final location if we've made it to this point
     print("Moving merged root into %s..." % os.path.dirname(outputDirs['final']))
 
-    src = outputDirs['intermediate']
-    dst = os.path.dirname(outputDirs['final'])
-    debug("move(%s, %s)" % (src, dst))
-    shutil.move(src, dst)
-
+    # both trees live in the same directory, so swapping them is just two renames
     src = outputDirs['final']
-    dst = outputDirs['intermediate']
-    debug("move(%s, %s)" % (src, dst))
-    shutil.move(src, dst)
+    dst = outputDirs['intermediate'] + STALE_DIR_SUFFIX
+    debug("rename(%s, %s)" % (src, dst))
+    os.rename(src, dst)
 
-    src = os.path.join(os.path.dirname(outputDirs['final']), os.path.basename(outputDirs['intermediate']))
+    src = outputDirs['intermediate']
     dst = outputDirs['final']
     debug("rename(%s, %s)" % (src, dst))
     os.rename(src, dst)
+
+    staleDirectoryPath = outputDirs['intermediate'] + STALE_DIR_SUFFIX
+    debug("rmtree(%s)" % staleDirectoryPath)
+    shutil.rmtree(staleDirectoryPath)
     
     # Determine OpenBSD release version and corresponding site package name
     sitePackageName = SITE_PACKAGE_NAME_TEMPLATE % (openBSDVersion(hostdef), hostname)
@@ -369,8 +401,6 @@ def main(argv):
 
     hostnames = args.hostnames
 
-    completedCount = 0
-    
     if hostnames == None or len(hostnames) == 0:
         hostnames = list()
         for hostdef in OortCommon.gHostMap:
@@ -379,9 +409,7 @@ def main(argv):
 
     debug("Hosts enqueued: %r" % hostnames)
     
-    for hostname in hostnames:
-        generateSitePackage(hostname)
-        completedCount += 1
+    completedCount = runForEachHost(generateSitePackage, hostnames, args)
     
     print("%i host%s generated." % (completedCount, "" if completedCount == 1 else "s"))
 	
@@ -39,6 +39,14 @@ import time
 from typing import List, Union
 
 
+#
+# CONSTANTS
+#
+DD_DEFAULT_BLOCK_SIZE =      "1m"
+DISK_REAPPEAR_DELAY_SECONDS = 5
+DD_BLOCK_SIZE_OPTIONS =      frozenset(["bs", "ibs", "obs", "count", "seek", "skip", "oseek", "iseek"]) # options whose meaning depends on block size
+
+
 #
 # GLOBAL VARIABLES
 #
@@ -79,6 +87,10 @@ class HumanBytes:
         if is_negative: # Faster than ternary assignment or always running abs().
             num = abs(num)
 
+        if num < unit_step_thresh:
+            # Fast path: already below the first threshold, so the loop below would stop at the first unit anyway.
+            return HumanBytes.PRECISION_FORMATS[precision].format("-" if is_negative else "", num, unit_labels[0])
+
         for unit in unit_labels:
             if num < unit_step_thresh:
                 # VERY IMPORTANT:
@@ -104,7 +116,8 @@ class HumanBytes:
 def selectRemovableDevice():
     chosenDeviceInfo = None
     devices = machdep_mounted_removable_devices()
-    if len(devices) > 1:
+    deviceCount = len(devices)
+    if deviceCount > 1:
         while chosenDeviceInfo is None:
             print("\n*** Select a removable device to ERASE and OVERWRITE with the OpenBSD installer image:")
             for idx, deviceInfo in enumerate(devices):
@@ -112,17 +125,17 @@ def selectRemovableDevice():
                 bsdNode = deviceInfo['node']
                 size = deviceInfo['size']
                 print('%i)  %s  (%s, %s)' % (idx+1, name, bsdNode, HumanBytes.format(size)))
-            userInput = input("\nDevice to ERASE and OVERWRITE (1-%i or disk node): " % len(devices))
+            userInput = input("\nDevice to ERASE and OVERWRITE (1-%i or disk node): " % deviceCount)
 
             if userInput.isnumeric():
                 idx = int(userInput)
-                if 1 <= idx <= len(devices):
+                if 1 <= idx <= deviceCount:
                     chosenDeviceInfo = devices[idx-1]
                 else:
-                    print("Input must be in the range 1-%i." % len(devices))
+                    print("Input must be in the range 1-%i." % deviceCount)
             else:
                 chosenDeviceInfo = next(filter(lambda deviceInfo: userInput == deviceInfo['node'], devices), None)
-    elif len(devices) == 1:
+    elif deviceCount == 1:
         chosenDeviceInfo = devices[0]
     else:
         error("No removable devices found.")
@@ -167,21 +180,26 @@ def flashNode(nodeName, manifest):
         assert not containsWhitespace(imagePath), "Absolute path ('%s') to image file '%s' must not contain any whitespace" % (imagePath, imageName)
         assert os.path.isabs(imagePath)
         assert os.path.isfile(imagePath)
-        command = ['dd', 'if=%s' % imagePath, 'of=/dev/%s' % nodeName]
-        if 'ddOptions' in imageInfo:
-            for k,v in imageInfo['ddOptions'].items():
-                assert not containsWhitespace(k)
-                assert not containsWhitespace(v)
-                command.append('%s=%s' % (k, v))
+        command = ['dd', 'if=%s' % imagePath, 'of=%s' % machdep_raw_disk_path(nodeName)]
+        ddOptions = imageInfo.get('ddOptions', dict())
+        for k,v in ddOptions.items():
+            assert not containsWhitespace(k)
+            assert not containsWhitespace(v)
+            command.append('%s=%s' % (k, v))
+        if DD_BLOCK_SIZE_OPTIONS.isdisjoint(ddOptions):
+            # dd defaults to 512-byte blocks; only safe to override if no option is expressed in blocks
+            command.append('bs=%s' % DD_DEFAULT_BLOCK_SIZE)
 
         debug("Adding command:  %r" % command)
         flashCommands.append(command)
 
-    for command in flashCommands:
+    for commandIndex, command in enumerate(flashCommands):
+        if commandIndex > 0:
+            # give the OS time to finish re-probing (and possibly re-mounting) the disk after the previous write
+            print("Waiting for disk to reappear...")
+            time.sleep(DISK_REAPPEAR_DELAY_SECONDS)
         machdep_unmount_disk(nodeName)
         runCommand(command, destructive=True, superuser=True)
-        print("Waiting for disk to reappear...")
-        time.sleep(5)
 
     print("Finished. %s is ready to install OpenBSD." % nodeName)
     input("\nPress Enter to eject %s...\n" % nodeName)
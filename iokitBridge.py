@@ -44,8 +44,9 @@ mach_port_t = c_void_p
 #   Constants
 k_io_name_t_buffer_length = 128
 #   Macros
+kIOServicePlane = b"IOService"
 def IOServicePlane():
-    return IOSTR("IOService")
+    return kIOServicePlane
 #
 # CoreFoundation
 #   Typedefs
@@ -74,6 +75,10 @@ def InitIOKitBridge():
     global iokit
     global cf
     global kIOMasterPortDefault
+    global bsdNamePropKey
+    global wholeDiskPropKey
+    global ejectablePropKey
+    global sizePropKey
     
     iokit = ctypes.cdll.LoadLibrary(ctypes.util.find_library('IOKit'))
     cf = ctypes.cdll.LoadLibrary(ctypes.util.find_library('CoreFoundation'))
@@ -99,6 +104,14 @@ def InitIOKitBridge():
     # CFTypeRef IORegistryEntryCreateCFProperty(io_registry_entry_t entry, CFStringRef key, CFAllocatorRef allocator, IOOptionBits options)
     iokit.IORegistryEntryCreateCFProperty.restype = CFTypeRef
     iokit.IORegistryEntryCreateCFProperty.argtypes = [io_registry_entry_t, CFStringRef, CFAllocatorRef, IOOptionBits]
+
+    # kern_return_t IORegistryEntryCreateCFProperties(io_registry_entry_t entry, CFMutableDictionaryRef *properties, CFAllocatorRef allocator, IOOptionBits options)
+    iokit.IORegistryEntryCreateCFProperties.restype = kern_return_t
+    iokit.IORegistryEntryCreateCFProperties.argtypes = [io_registry_entry_t, POINTER(CFMutableDictionaryRef), CFAllocatorRef, IOOptionBits]
+
+    # kern_return_t IOObjectRelease(io_object_t object)
+    iokit.IOObjectRelease.restype = kern_return_t
+    iokit.IOObjectRelease.argtypes = [io_object_t]
     
     # kern_return_t IORegistryEntryGetNameInPlane(io_registry_entry_t entry, const io_name_t plane, io_name_t name)
     iokit.IORegistryEntryGetNameInPlane.restype = kern_return_t
@@ -111,6 +124,10 @@ def InitIOKitBridge():
     # CFIndex CFStringGetLength(CFStringRef theString)
     cf.CFStringGetLength.restype = CFIndex
     cf.CFStringGetLength.argtypes = [CFStringRef]
+
+    # CFIndex CFStringGetMaximumSizeForEncoding(CFIndex length, CFStringEncoding encoding)
+    cf.CFStringGetMaximumSizeForEncoding.restype = CFIndex
+    cf.CFStringGetMaximumSizeForEncoding.argtypes = [CFIndex, CFStringEncoding]
     
     # Boolean CFStringGetCString(CFStringRef theString, char *buffer, CFIndex bufferSize, CFStringEncoding encoding)
     cf.CFStringGetCString.restype = Boolean
@@ -123,6 +140,20 @@ def InitIOKitBridge():
     # Boolean CFBooleanGetValue(CFBooleanRef boolean)
     cf.CFBooleanGetValue.restype = Boolean
     cf.CFBooleanGetValue.argtypes = [CFBooleanRef]
+
+    # const void *CFDictionaryGetValue(CFDictionaryRef theDict, const void *key)
+    cf.CFDictionaryGetValue.restype = CFTypeRef
+    cf.CFDictionaryGetValue.argtypes = [CFDictionaryRef, c_void_p]
+
+    # void CFRelease(CFTypeRef cf)
+    cf.CFRelease.restype = None
+    cf.CFRelease.argtypes = [CFTypeRef]
+
+    # Property keys, created once and kept for the life of the process
+    bsdNamePropKey = CFSTR("BSD Name")
+    wholeDiskPropKey = CFSTR("Whole")
+    ejectablePropKey = CFSTR("Ejectable")
+    sizePropKey = CFSTR("Size")
     
     return kIOMasterPortDefault
     
@@ -131,7 +162,7 @@ def InitIOKitBridge():
 # METHODS
 #
 def IOSTR(string):
-    buffer = ctypes.create_string_buffer(k_io_name_t_buffer_length)
+    return ctypes.create_string_buffer(string.encode('UTF-8'), k_io_name_t_buffer_length)
 
 
 def CFSTR(string):
@@ -139,9 +170,10 @@ def CFSTR(string):
 
 
 def stringFromCFString(cfstr):
-    length = cf.CFStringGetLength(cfstr)
-    buffer = ctypes.create_string_buffer(length)
-    cf.CFStringGetCString(cfstr, buffer, length + 1, kCFStringEncodingUTF8)
+    # the length is in UTF-16 code units, so ask how many bytes that can take in UTF-8 (plus a NUL terminator)
+    bufferSize = cf.CFStringGetMaximumSizeForEncoding(cf.CFStringGetLength(cfstr), kCFStringEncodingUTF8) + 1
+    buffer = ctypes.create_string_buffer(bufferSize)
+    cf.CFStringGetCString(cfstr, buffer, bufferSize, kCFStringEncodingUTF8)
     return buffer.value.decode('UTF-8')
 
 
@@ -159,6 +191,14 @@ def IOGetProperty(entry, key):
     return iokit.IORegistryEntryCreateCFProperty(entry, key, None, None)
 
 
+def IOCopyProperties(entry):
+    # Returns a dictionary of all of the entry's properties, which the caller must CFRelease()
+    properties = CFMutableDictionaryRef()
+    if iokit.IORegistryEntryCreateCFProperties(entry, ctypes.byref(properties), None, None) != 0:
+        return None
+    return properties
+
+
 def iokitGetMountedRemovableDevices():
     global iokit
     global cf
@@ -176,36 +216,37 @@ def iokitGetMountedRemovableDevices():
         ctypes.byref(iterator)
     )
     
-    bsdNamePropKey = CFSTR("BSD Name")
-    wholeDiskPropKey = CFSTR("Whole")
-    ejectablePropKey = CFSTR("Ejectable")
-    sizePropKey = CFSTR("Size")
+    buffer = ctypes.create_string_buffer(k_io_name_t_buffer_length)
 
     while (entry := iokit.IOIteratorNext(iterator)) != None :
-        bsdNameCFStr = IOGetProperty(entry, bsdNamePropKey)
-        bsdName = stringFromCFString(bsdNameCFStr)
-
-        wholeDiskCFBool = IOGetProperty(entry, wholeDiskPropKey)
-        wholeDisk = boolFromCFBoolean(wholeDiskCFBool)
-
-        ejectableCFBool = IOGetProperty(entry, ejectablePropKey)
-        ejectable = boolFromCFBoolean(ejectableCFBool)
-
-        if wholeDisk and ejectable:
-            buffer = ctypes.create_string_buffer(k_io_name_t_buffer_length)
-            iokit.IORegistryEntryGetNameInPlane(entry, IOServicePlane(), buffer)
-            name = buffer.value.decode('UTF-8')
-            
-            sizeCFNum = IOGetProperty(entry, sizePropKey)
-            size = longLongFromCFNumber(sizeCFNum)
-
-            deviceInfo = {
-                'name': name,
-                'node': bsdName,
-                'size': size
-            }
-
-            devices.append(deviceInfo)
+        # Fetch all of the entry's properties in one call rather than one call per property
+        properties = IOCopyProperties(entry)
+        if properties is not None:
+            # values from CFDictionaryGetValue() are owned by the dictionary and must not be released
+            wholeDisk = boolFromCFBoolean(cf.CFDictionaryGetValue(properties, wholeDiskPropKey))
+            ejectable = boolFromCFBoolean(cf.CFDictionaryGetValue(properties, ejectablePropKey))
+
+            if wholeDisk and ejectable:
+                bsdName = stringFromCFString(cf.CFDictionaryGetValue(properties, bsdNamePropKey))
+
+                buffer[0] = b'\0'
+                iokit.IORegistryEntryGetNameInPlane(entry, IOServicePlane(), buffer)
+                name = buffer.value.decode('UTF-8')
+                
+                size = longLongFromCFNumber(cf.CFDictionaryGetValue(properties, sizePropKey))
+
+                deviceInfo = {
+                    'name': name,
+                    'node': bsdName,
+                    'size': size
+                }
+
+                devices.append(deviceInfo)
+
+            cf.CFRelease(properties)
+        iokit.IOObjectRelease(entry)
+
+    iokit.IOObjectRelease(iterator)
 
     return devices
     
@@ -55,8 +55,14 @@ def machdep_erase_disk(nodeName):
 def machdep_validate_disk_node(nodeName):
     return machdep().validate_disk_node(nodeName)
 
+def machdep_raw_disk_path(nodeName):
+    return machdep().raw_disk_path(nodeName)
+
 def machdep_platform():
-    return os.uname().sysname
+    global gPlatform
+    if gPlatform is None:
+        gPlatform = os.uname().sysname
+    return gPlatform
     
 #
 # PRIVATE API
@@ -64,10 +70,8 @@ def machdep_platform():
 
 import os
 
-from machdep_darwin import Darwin
-from machdep_openbsd import OpenBSD
-
 gMachdep = None
+gPlatform = None
 
 class Machdep(object):
 
@@ -86,12 +90,18 @@ class Machdep(object):
     def validate_disk_node(self, nodeName):
         raise NotImplementedError()
 
+    def raw_disk_path(self, nodeName):
+        raise NotImplementedError()
+
     
 def GetMachindDependentClassName():
-    osName = os.uname().sysname
+    osName = machdep_platform()
+    # only import the module for the platform we're actually running on
     if osName == "Darwin":
+        from machdep_darwin import Darwin
         return Darwin
     elif osName == "OpenBSD":
+        from machdep_openbsd import OpenBSD
         return OpenBSD
     else:
         error("The %s operating system is not currently supported." % osName)
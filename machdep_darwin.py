@@ -27,7 +27,9 @@ from __future__ import annotations
 import os
 import re
 import signal
+import stat
 import subprocess
+import sys
 
 #
 # Try to avoid import recursion
@@ -37,6 +39,13 @@ if TYPE_CHECKING:
     from machdep import Machdep
 
 
+#
+# CONSTANTS
+#
+RUN_COMMAND_READ_SIZE = 64 * 1024
+DISK_NODE_NAME_PATTERN = re.compile(r'disk[0-9]{1,2}')
+
+
 #
 # CLASSES
 #
@@ -60,9 +69,12 @@ class Darwin:
             cmd.insert(0, 'sudo')
 
         try:
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True) as cmd:
-                for line in cmd.stdout:
-                    print(line, end='')
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE) as cmd:
+                # relay output in whatever chunks it arrives in rather than decoding and printing line by line
+                sys.stdout.flush()
+                while output := os.read(cmd.stdout.fileno(), RUN_COMMAND_READ_SIZE):
+                    sys.stdout.buffer.write(output)
+                    sys.stdout.buffer.flush()
         except KeyboardInterrupt:
             cmd.send_signal(signal.SIGINT)
     
@@ -88,8 +100,12 @@ class Darwin:
 
 
     def validate_disk_node(self, nodeName):
-        assert re.fullmatch(r'^disk[0-9]{1,2}$', nodeName) is not None, "nodeName '%s' is invalid!" % nodeName
+        assert DISK_NODE_NAME_PATTERN.fullmatch(nodeName) is not None, "nodeName '%s' is invalid!" % nodeName
         nodePath = os.path.join(r'/dev/', nodeName)
-        assert os.path.exists(nodePath)
-        assert not os.path.isdir(nodePath)
-        assert not os.path.isfile(nodePath)
+        nodeMode = os.stat(nodePath).st_mode
+        assert stat.S_ISBLK(nodeMode) or stat.S_ISCHR(nodeMode), "'%s' is not a device node" % nodePath
+
+
+    def raw_disk_path(self, nodeName):
+        # the character device bypasses the buffer cache, which makes large sequential writes much faster
+        return os.path.join(r'/dev/', 'r' + nodeName)
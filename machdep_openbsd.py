@@ -27,6 +27,7 @@ from __future__ import annotations
 import os
 import signal
 import subprocess
+import sys
 
 #
 # Try to avoid import recursion
@@ -36,6 +37,12 @@ if TYPE_CHECKING:
     from machdep import Machdep
 
 
+#
+# CONSTANTS
+#
+RUN_COMMAND_READ_SIZE = 64 * 1024
+
+
 #
 # CLASSES
 #
@@ -59,9 +66,12 @@ class OpenBSD:
             cmd.insert(0, 'doas')
 
         try:
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True) as cmd:
-                for line in cmd.stdout:
-                    print(line, end='')
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE) as cmd:
+                # relay output in whatever chunks it arrives in rather than decoding and printing line by line
+                sys.stdout.flush()
+                while output := os.read(cmd.stdout.fileno(), RUN_COMMAND_READ_SIZE):
+                    sys.stdout.buffer.write(output)
+                    sys.stdout.buffer.flush()
         except KeyboardInterrupt:
             cmd.send_signal(signal.SIGINT)
     
@@ -34,14 +34,21 @@ from createSiteFiles import generateSitePackage, autoinstallConfigurationRootPat
 
 # STANDARD LIBRARIES
 import base64
-from pathlib import Path
-import requests
-from requests.compat import urljoin
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
+import fcntl
+import functools
+import grp
+import hashlib
+import json
+import pwd
 import shutil
-import subprocess
+import stat
 import tarfile
-import tempfile
+import threading
+import time
 import urllib.request
+from urllib.parse import urljoin
 
 
 # EXTERNAL LIBRARIES
@@ -63,12 +70,22 @@ MIRROR_ROOT_HTTP_URL=       'https://cdn.openbsd.org/pub/OpenBSD/'
 
 HASH_FILENAME =             "SHA256"
 HASH_SIGNED_FILENAME =      "SHA256.sig"
+HASH_LINE_HEX_PATTERN =     re.compile(r'SHA256 \(([+\w._-]+)\) = ([0-9A-Fa-f]{64})$', re.IGNORECASE)
+HASH_LINE_BASE64_PATTERN =  re.compile(r'SHA256 \(([+\w._-]+)\) = ([/\w=+]{44})$', re.IGNORECASE)
 INSTALL_IMAGE_BASENAME =    'miniroot'
 INSTALL_IMAGE_EXTENSION =   '.img'
 
 USES_PYCURL = True
+CURL_CONNECT_TIMEOUT_SECONDS =  15
+CURL_LOW_SPEED_LIMIT_BYTES =    1024    # abort a transfer that stays below this many bytes/second...
+CURL_LOW_SPEED_TIME_SECONDS =   30      # ...for this many seconds
 
 SET_PACKAGE_DIR_LISTING_FILENAME = "index.txt"
+SET_PACKAGE_DIR_LISTING_RECENT_SECONDS = 6 * 30 * 24 * 60 * 60 # like ls(1), show the time rather than the year for files newer than ~6 months
+SET_PACKAGE_DOWNLOAD_THREADS = 4 # number of set packages to download concurrently
+DOWNLOAD_LOCK_FILENAME =    ".download.lock"
+DOWNLOAD_PARTIAL_SUFFIX =   ".part"
+VERIFIED_DOWNLOADS_FILENAME = ".verified.json" # per mirror directory: files whose hashes were verified by an earlier run
 
 SET_PACKAGE_NAMES = [
     "bsd",
@@ -92,6 +109,7 @@ SET_PACKAGE_OPTIONAL_NAMES = [
 # HTTP response codes
 HTTP_OK = 200
 HTTP_PARTIAL_CONTENT = 206
+HTTP_RANGE_NOT_SATISFIABLE = 416  # returned when resuming from the end of (or past) the remote file
 HTTP_CONTINUABLE_RESPONSE_CODES = [
     HTTP_OK,
     HTTP_PARTIAL_CONTENT
@@ -101,7 +119,10 @@ HTTP_CONTINUABLE_RESPONSE_CODES = [
 # GLOBAL VARIABLES
 #
 # Persistent
-gVerifiedDownloads = set()
+gVerifiedDownloads = dict()    # key: (device, inode, size, mtime in ns) of a verified download, value: its SHA256 digest
+gCurlHandles = threading.local()    # one curl handle per thread, reused so that connections to the mirror are kept alive
+gDownloadStateLock = threading.Lock()   # guards gVerifiedDownloads and gMissingOptionalPackageNames during concurrent downloads
+gSHA256TableCache = dict()  # key: (path, mtime in ns, size), value: parsed SHA256 table (see loadSHA256DirectoryTable())
 gBootloaderPackageInfoCache = dict()
 # Per-host... must be reset!
 gMissingOptionalPackageNames = dict()
@@ -113,9 +134,8 @@ gMissingOptionalPackageNames = dict()
 def prepareDownloadDirectories(hostdef, buildRootPath):
     print("Preparing download directory tree in '%s'..." % buildRootPath)
     
+    # Only the leaf directories are created explicitly; makeDirIfNeeded() creates any missing parents along the way
     dlRootDirPath = os.path.join(buildRootPath, DOWNLOAD_ROOT_NAME)
-    debug("Creating top-level download directory '%s'..." % dlRootDirPath)
-    makeDirIfNeeded(dlRootDirPath)
 
     flavor = hostdef[HOSTMAP_FIELD_OSFLAVOR]
     if flavor == OSFLAVOR_STABLE:
@@ -126,8 +146,6 @@ def prepareDownloadDirectories(hostdef, buildRootPath):
         error("Unknown OpenBSD flavor '%s'" % flavor)
         
     flavorDirPath = os.path.join(dlRootDirPath, flavorDirName)
-    debug("Creating flavor download directory '%s'..." % flavorDirPath)
-    makeDirIfNeeded(flavorDirPath)
 
     sysArch = sysArchNameForBoard(hostdef[HOSTMAP_FIELD_BOARD])
     pkgArch = pkgArchNameForBoard(hostdef[HOSTMAP_FIELD_BOARD])
@@ -150,12 +168,7 @@ def prepareStagingDirectories(hostdef, buildRootPath):
     print("Preparing staging directory tree in '%s'..." % buildRootPath)
     
     stageRootDirPath = os.path.join(buildRootPath, STAGING_ROOT_NAME)
-    debug("Creating top-level staging directory '%s'..." % stageRootDirPath)
-    makeDirIfNeeded(stageRootDirPath)
-    
     stageDirPath = os.path.join(stageRootDirPath, hostdef[HOSTMAP_FIELD_HOSTNAME])
-    debug("Creating host staging directory '%s'..." % stageDirPath)
-    makeDirIfNeeded(stageDirPath)
     
     installDirPath = os.path.join(stageDirPath, STAGING_INSTALLDISK_NAME)
     debug("Creating install-boot disk staging directory '%s'..." % installDirPath)
@@ -175,13 +188,7 @@ def prepareNetbootDirectories(hostdef, buildRootPath):
     print("Preparing netboot directory tree in '%s'..." % buildRootPath)
     
     netbootRuntimeDirPath = os.path.join(buildRootPath, NETBOOT_RUNTIME_NAME)
-    debug("Creating netboot runtime directory '%s'..." % netbootRuntimeDirPath)
-    makeDirIfNeeded(netbootRuntimeDirPath)
-    
     netbootFsrootDirPath = os.path.join(netbootRuntimeDirPath, NETBOOT_ROOT_NAME)
-    debug("Creating netboot fileroot directory '%s'..." % netbootFsrootDirPath)
-    makeDirIfNeeded(netbootFsrootDirPath)
-    
     netbootHostDirPath = os.path.join(netbootFsrootDirPath, hostdef[HOSTMAP_FIELD_HOSTNAME])
     debug("Creating netboot host-specific directory '%s'..." % netbootHostDirPath)
     makeDirIfNeeded(netbootHostDirPath)
@@ -193,7 +200,36 @@ def prepareNetbootDirectories(hostdef, buildRootPath):
     }
 
 
+def loadSHA256DirectoryTable(hashFilePath):
+    # Parse each hash file once, re-parsing only if it has since been re-downloaded
+    st = os.stat(hashFilePath)
+    cacheKey = (os.path.abspath(hashFilePath), st.st_mtime_ns, st.st_size)
+    table = gSHA256TableCache.get(cacheKey)
+    if table is None:
+        debug("parsing %s", hashFilePath)
+        table = dict()  # key: filename, value: raw hash bytes (in file order)
+        with open(hashFilePath, "r") as hashFile:
+            for line in hashFile:
+                # no need to strip the line: match() anchors at its start and '$' also matches before its trailing newline
+                # first check for hashes written in hexadecimal format
+                lineSearch = HASH_LINE_HEX_PATTERN.match(line)
+                if lineSearch:
+                    sha256 = bytes.fromhex(lineSearch.group(2))
+                else:
+                    # if not found, check again in Base64 format
+                    lineSearch = HASH_LINE_BASE64_PATTERN.match(line)
+                    if lineSearch:
+                        sha256 = base64.b64decode(lineSearch.group(2))
+                if lineSearch:
+                    table.setdefault(lineSearch.group(1), sha256)
+        gSHA256TableCache[cacheKey] = table
+    return table
+
+
 def lookupFilenameInSHA256DirectoryTable(hashFilePath, targetFilename):
+    sha256 = loadSHA256DirectoryTable(hashFilePath).get(targetFilename)
+    if sha256 is not None:
+        return sha256
     patternMatch = matchFilenamePatternInSHA256DirectoryTable(hashFilePath, targetFilename)
     return patternMatch['hash'] if patternMatch is not None else None
 
@@ -203,30 +239,14 @@ def matchFilenamePatternInSHA256DirectoryTable(hashFilePath, targetFilenamePatte
     result = dict()  # keys: 'filename', 'hash'
     sha256 = None
     matchedFilename = None
-    with open(hashFilePath, "r") as hashFile:
-        for line in hashFile:
-            line = line.strip()
-            # first check for hashes written in hexadecimal format
-            debug("checking line %s" % line)
-            lineSearch = re.search(r'^SHA256 \(([+\w._-]+)\) = ([0-9A-Fa-f]{64})$', line, re.IGNORECASE)
-            if lineSearch:
-                lineFilename = lineSearch.group(1)
-                filenameScan = re.search('(' + targetFilenamePattern + ')', lineFilename)
-                if filenameScan:
-                    matchedFilename = filenameScan.group(1)
-                    sha256 = lineSearch.group(2)
-                    break
-            else:
-                # if not found, check again in Base64 format
-                lineSearch = re.search(r'^SHA256 \(([+\w._-]+)\) = ([/\w=+]{44})$', line, re.IGNORECASE)
-                if lineSearch:
-                    lineFilename = lineSearch.group(1)
-                    filenameScan = re.search('(' + targetFilenamePattern + ')', lineFilename)
-                    if filenameScan:
-                        matchedFilename = filenameScan.group(1)
-                        sha256 = base64.b64decode(lineSearch.group(2)).hex()
-                        break
-    debug("lookup %s: %s -> %s = %s" % (hashFilePath, targetFilenamePattern, matchedFilename, sha256))
+    filenamePattern = re.compile('(' + targetFilenamePattern + ')')
+    for lineFilename, lineHash in loadSHA256DirectoryTable(hashFilePath).items():
+        filenameScan = filenamePattern.search(lineFilename)
+        if filenameScan:
+            matchedFilename = filenameScan.group(1)
+            sha256 = lineHash
+            break
+    debug("lookup %s: %s -> %s = %s" % (hashFilePath, targetFilenamePattern, matchedFilename, sha256.hex() if sha256 is not None else None))
     if matchedFilename is not None and sha256 is not None:
         result['hash'] = sha256
         result['filename'] = matchedFilename
@@ -303,12 +323,47 @@ def bootloaderPackagesInfoForHost(hostdef):
     return bootloaderPackagesInfo
 
 
+def curlHandle(url):
+    # Reset the shared handle's options but not its connection cache
+    c = getattr(gCurlHandles, 'curl', None)
+    if c is None:
+        c = pycurl.Curl()
+        gCurlHandles.curl = c
+    else:
+        c.reset()
+    c.setopt(pycurl.URL, url)
+    c.setopt(pycurl.FOLLOWLOCATION, 1)
+    c.setopt(pycurl.MAXREDIRS, 5)
+    c.setopt(pycurl.FAILONERROR, 1)
+    c.setopt(pycurl.CONNECTTIMEOUT, CURL_CONNECT_TIMEOUT_SECONDS)
+    c.setopt(pycurl.LOW_SPEED_LIMIT, CURL_LOW_SPEED_LIMIT_BYTES)
+    c.setopt(pycurl.LOW_SPEED_TIME, CURL_LOW_SPEED_TIME_SECONDS)
+    if hasattr(pycurl, "CURL_HTTP_VERSION_2TLS"):
+        # HTTP/2 over TLS where libcurl and the mirror support it, otherwise HTTP/1.1
+        c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+    return c
+
+
 def downloadUrl(url, destPath):
     debug("[download] %s -> %s" % (url, destPath))
     
-    with open(destPath, "wb") as destFile:
-        with urllib.request.urlopen(url) as response:
-            shutil.copyfileobj(response, destFile)
+    # Download beside the destination and move it into place when complete, so that a host being staged from the
+    # same mirror directory never sees a truncated or half-written file
+    partialPath = destPath + DOWNLOAD_PARTIAL_SUFFIX
+    try:
+        with open(partialPath, "wb") as destFile:
+            if USES_PYCURL:
+                c = curlHandle(url)
+                c.setopt(pycurl.WRITEDATA, destFile)
+                c.perform()
+            else:
+                with urllib.request.urlopen(url) as response:
+                    shutil.copyfileobj(response, destFile)
+        os.replace(partialPath, destPath)
+    except BaseException:
+        if os.path.exists(partialPath):
+            os.remove(partialPath)
+        raise
 
     # XXX NEED TO ABORT FOR FAILED DOWNLOADS
     
@@ -333,59 +388,125 @@ def isDownloadRequired(filename, kind):
 # (i.e., one of the keys returned in prepareStagingDirectories()) and its "source"
 # location (i.e., one of the keys returned in prepareDownloadDirectories()), e.g.,
 # "install_system", "install_package", "sets_package"
-def downloadResumableUrl(url, destPath, kind):
+def downloadResumableUrl(url, destPath, kind, showProgress = True):
     debug("[rdownload][%s] %s -> %s" % (kind, url, destPath))
 
     downloadSucceeded = False
     
     if USES_PYCURL:
-        c = pycurl.Curl()
-        c.setopt(pycurl.URL, url)
-        c.setopt(pycurl.FOLLOWLOCATION, 1)
-        c.setopt(pycurl.MAXREDIRS, 5)
-        c.setopt(pycurl.NOPROGRESS, False)
-        c.setopt(pycurl.XFERINFOFUNCTION, callbackDownloadProgress)
-        c.setopt(pycurl.FAILONERROR, 1)
-
+        c = curlHandle(url)
+        if showProgress:
+            c.setopt(pycurl.NOPROGRESS, False)
+            c.setopt(pycurl.XFERINFOFUNCTION, callbackDownloadProgress)
+
+        # Hash the file as it is written rather than reading it back afterwards
+        hasher = hashlib.sha256()
+        resumeOffset = 0
         if os.path.exists(destPath):
             f = open(destPath, "ab")
-            c.setopt(pycurl.RESUME_FROM, os.path.getsize(destPath))
+            with open(destPath, "rb") as existingFile:
+                while (block := existingFile.read(SHA256_READ_CHUNK_SIZE)):
+                    hasher.update(block)
+            resumeOffset = os.path.getsize(destPath)
+            c.setopt(pycurl.RESUME_FROM, resumeOffset)
         else:
             f = open(destPath, "wb")
-        c.setopt(pycurl.WRITEDATA, f)
-    
-        try:
-            c.perform()
-        except:
-            if os.path.getsize(destPath) == 0:
-                os.remove(destPath)
-        print("") # need a newline after c.perform()'s repeated invocations of callbackDownloadProgress()
+
+        def writeAndHash(data):
+            hasher.update(data)
+            f.write(data)
+            return len(data)
+        c.setopt(pycurl.WRITEFUNCTION, writeAndHash)
+    
+        with f:
+            try:
+                c.perform()
+            except:
+                if os.path.getsize(destPath) == 0:
+                    os.remove(destPath)
+        if showProgress:
+            print("") # need a newline after c.perform()'s repeated invocations of callbackDownloadProgress()
         
         response = c.getinfo(pycurl.RESPONSE_CODE)
-        if not response in HTTP_CONTINUABLE_RESPONSE_CODES:
+        if response == HTTP_RANGE_NOT_SATISFIABLE and resumeOffset > 0:
+            # Nothing left to fetch; the caller's hash check catches a local file that is larger than the remote one
+            debug("%s already complete at %i bytes", destPath, resumeOffset)
+            downloadSucceeded = True
+            rememberSha256(destPath, hasher.digest())
+        elif not response in HTTP_CONTINUABLE_RESPONSE_CODES:
             print("Failed to download %s; got HTTP response code %i" % (url, response))
             downloadSucceeded = False
         else:
             downloadSucceeded = True
+            rememberSha256(destPath, hasher.digest())
     else:
         error("No non-pycurl implementation yet!")
         downloadSucceeded = False
 
     if not downloadSucceeded:
-        remoteFilename = os.path.basename(urllib.parse.urlsplit(url).path)
+        remoteFilename = os.path.basename(destPath) # always saved under its remote name
         if isDownloadRequired(remoteFilename, kind):
             error("Can't proceed without required %s download '%s'" % (kind, remoteFilename))
         else:
             global gMissingOptionalPackageNames
-            if kind not in gMissingOptionalPackageNames:
-                gMissingOptionalPackageNames[kind] = set()
-            gMissingOptionalPackageNames[kind].add(remoteFilename)
+            with gDownloadStateLock:
+                if kind not in gMissingOptionalPackageNames:
+                    gMissingOptionalPackageNames[kind] = set()
+                gMissingOptionalPackageNames[kind].add(remoteFilename)
             debug("Added %s to %s missing optional packages" % (remoteFilename, kind))
         
     return downloadSucceeded
 
 
-def downloadResumableUrlIfNeeded(url, destPath, kind):
+def verifiedDownloadKey(path):
+    # Identify a download by its file rather than its path spelling, so that any change to the file invalidates it
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def loadVerifiedDownloadRecords(dirPath):
+    # key: filename, value: [inode, size, mtime in ns, hex SHA256] as of when it was verified
+    return loadJSONIfPresent(os.path.join(dirPath, VERIFIED_DOWNLOADS_FILENAME)) or dict()
+
+
+def previouslyVerifiedSha256(destPath):
+    # Returns the hash an earlier run verified for this file, provided the file hasn't changed since
+    record = loadVerifiedDownloadRecords(os.path.dirname(destPath)).get(os.path.basename(destPath))
+    if record is None:
+        return None
+    st = os.stat(destPath)
+    if record[:3] != [st.st_ino, st.st_size, st.st_mtime_ns]:
+        return None
+    return bytes.fromhex(record[3])
+
+
+def recordVerifiedDownload(destPath, sha256):
+    # Callers hold the directory's downloadDirectoryLock(); gDownloadStateLock covers our own threads
+    dirPath = os.path.dirname(destPath)
+    st = os.stat(destPath)
+    with gDownloadStateLock:
+        records = loadVerifiedDownloadRecords(dirPath)
+        records[os.path.basename(destPath)] = [st.st_ino, st.st_size, st.st_mtime_ns, sha256.hex()]
+        recordsPath = os.path.join(dirPath, VERIFIED_DOWNLOADS_FILENAME)
+        with open(recordsPath + ".tmp", "w") as recordsFile:
+            json.dump(records, recordsFile, indent=4, sort_keys=True)
+        os.replace(recordsPath + ".tmp", recordsPath)
+
+
+def expectedSha256ForDownload(url, destPath):
+    sha256FilePath = os.path.join(os.path.dirname(destPath), HASH_FILENAME)
+    if not os.path.isfile(sha256FilePath):
+        error("no directory hash file found at %s" % sha256FilePath)
+    remoteFilename = os.path.basename(destPath) # always saved under its remote name
+    remoteHash = lookupFilenameInSHA256DirectoryTable(sha256FilePath, remoteFilename)
+    assert remoteHash is not None, "Can't find '%s' in '%s'" % (remoteFilename, sha256FilePath)
+    return remoteHash
+
+
+def downloadResumableUrlIfNeeded(url, destPath, kind, showProgress = True):
     debug("[rdownload?][%s] %s -> %s" % (kind, url, destPath))
 
     downloadSucceeded = False
@@ -393,55 +514,45 @@ def downloadResumableUrlIfNeeded(url, destPath, kind):
     remoteHash = None
     
     # maintain a global cache of everything downloaded since the program began
-    if not destPath in gVerifiedDownloads:
+    if not verifiedDownloadKey(destPath) in gVerifiedDownloads and os.path.isfile(destPath):
+        # Trust an unchanged file that an earlier run verified against the same hash, without re-reading it
+        previousHash = previouslyVerifiedSha256(destPath)
+        if previousHash is not None and previousHash == expectedSha256ForDownload(url, destPath):
+            debug("%s verified by an earlier run", destPath)
+            rememberSha256(destPath, previousHash)
+            with gDownloadStateLock:
+                gVerifiedDownloads[verifiedDownloadKey(destPath)] = previousHash
+
+    if not verifiedDownloadKey(destPath) in gVerifiedDownloads:
         if os.path.isfile(destPath):
-            # First compare local file size to remote file size
-            remoteSize = int(requests.head(url).headers.get('content-length', 0))
-            localSize = os.path.getsize(destPath)
-            debug("localSize = %i, remoteSize = %i" % (localSize, remoteSize))
-            # If local file is smaller, resume download
-            if localSize < remoteSize:
-                print("resuming download (%s -> %s) at %i of %i bytes" % (url, destPath, localSize, remoteSize))
-                downloadSucceeded = downloadResumableUrl(url, destPath, kind)
-            # If local file is larger, automatically do a full redownload
-            elif localSize > remoteSize:
-                print("local download (%s -> %s) too large (%s bytes; %s expected); redownloading" % (url, destPath, localSize, remoteSize))
-                os.remove(destPath)
-                downloadSucceeded = downloadResumableUrl(url, destPath, kind)
-            else:
-                # complete file already exists - nothing to do
-                debug("%s already exists; %s bytes" % (destPath, localSize))
-                downloadSucceeded = True
-        else:
-            downloadSucceeded = downloadResumableUrl(url, destPath, kind)
+            # Resume from the local file's size and let the server say whether anything is left to fetch
+            print("resuming download (%s -> %s) at %i bytes" % (url, destPath, os.path.getsize(destPath)))
+        downloadSucceeded = downloadResumableUrl(url, destPath, kind, showProgress)
 
         if downloadSucceeded:
             # Compare SHA256 hashes in all cases in case server file changed
-            sha256FilePath = os.path.join(os.path.dirname(destPath), HASH_FILENAME)
-            if not os.path.isfile(sha256FilePath):
-                error("no directory hash file found at %s" % sha256FilePath)
-            remoteFilename = os.path.basename(urllib.parse.urlsplit(url).path)
-            remoteHash = lookupFilenameInSHA256DirectoryTable(sha256FilePath, remoteFilename)
-            assert remoteHash is not None, "Can't find '%s' in '%s'" % (remoteFilename, sha256FilePath)
-
-            localHash = sha256(destPath)
+            remoteHash = expectedSha256ForDownload(url, destPath)
+
+            localHash = sha256(destPath) # already known (without re-reading the file) if it was just downloaded
             assert localHash is not None, "Can't compute hash for '%s'" % destPath
-            debug("lhash/rhash: %s / %s" % (localHash, remoteHash))
+            debug("lhash/rhash: %s / %s" % (localHash.hex(), remoteHash.hex()))
     
             # If hash mismatch, try full download one more time
             if localHash != remoteHash:
-                print("Hash mismatch! %s (%s) != %s (%s)" % (url, remoteHash, destPath, localHash))
+                print("Hash mismatch! %s (%s) != %s (%s)" % (url, remoteHash.hex(), destPath, localHash.hex()))
                 os.remove(destPath)
                 localHash = None
-                downloadSucceeded = downloadResumableUrl(url, destPath, kind)
+                downloadSucceeded = downloadResumableUrl(url, destPath, kind, showProgress)
                 if downloadSucceeded:
                     localHash = sha256(destPath)
                     if localHash != remoteHash:
-                        error("SHA256 hashes do not match after redownload! %s (%s) != %s (%s)" % (url, remoteHash, destPath, localHash))
+                        error("SHA256 hashes do not match after redownload! %s (%s) != %s (%s)" % (url, remoteHash.hex(), destPath, localHash.hex()))
         
             if downloadSucceeded and localHash is not None and remoteHash is not None and localHash == remoteHash:
-                print("Hash verified: %s" % localHash)
-                gVerifiedDownloads.add(destPath)
+                print("Hash verified: %s" % localHash.hex())
+                with gDownloadStateLock:
+                    gVerifiedDownloads[verifiedDownloadKey(destPath)] = localHash
+                recordVerifiedDownload(destPath, localHash)
             else:
                 downloadSucceeded = False
     else:
@@ -451,13 +562,36 @@ def downloadResumableUrlIfNeeded(url, destPath, kind):
     return downloadSucceeded
         
     
+@functools.lru_cache(maxsize=None)
+def setPackageFilenamesForVersion(openBSDVersionString):
+    return tuple(setPackagePattern.replace('%VERSION', openBSDVersionString) for setPackagePattern in SET_PACKAGE_NAMES)
+
+
+@contextlib.contextmanager
+def downloadDirectoryLock(dirPath, lockType = fcntl.LOCK_EX):
+    # Hosts mastered in parallel may share a mirror directory, so only one process may download into it at a time
+    # (LOCK_EX), and not while others are staging from it (LOCK_SH)
+    with open(os.path.join(dirPath, DOWNLOAD_LOCK_FILENAME), "w") as lockFile:
+        fcntl.flock(lockFile, lockType)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+
 def downloadImagesForHost(hostdef):
-    boardName = hostdef[HOSTMAP_FIELD_BOARD]
-    openBSDVersionString = openBSDVersion(hostdef)
-    
     # Create download directories
     outputDirs = prepareDownloadDirectories(hostdef, configValue(CONFIG_KEY_BUILD_ROOT_PATH))
     debug("Download directories: %r" % outputDirs)
+
+    # Always lock the system directory before the package directory so that parallel hosts can't deadlock
+    with downloadDirectoryLock(outputDirs['system']), downloadDirectoryLock(outputDirs['package']):
+        return downloadImagesIntoDirectoriesForHost(hostdef, outputDirs)
+
+
+def downloadImagesIntoDirectoriesForHost(hostdef, outputDirs):
+    boardName = hostdef[HOSTMAP_FIELD_BOARD]
+    openBSDVersionString = openBSDVersion(hostdef)
     
     # Determine URL for downloading install sets based on OpenBSD version and architecture
     setsUrl = urlForHostInstallSets(hostdef)
@@ -520,29 +654,41 @@ def downloadImagesForHost(hostdef):
     
     # Download fileset packages
     print("Getting fileset packages...")
-    setPackageFilenames = list()
-    for setPackagePattern in SET_PACKAGE_NAMES:
-        setPackageFilename = setPackagePattern.replace('%VERSION', openBSDVersionString)
-        setPackageFilenames.append(setPackageFilename)
-        print("Downloading '%s'..." % setPackageFilename)
-        setPackageUrl = urljoin(archSetsUrl, setPackageFilename)
-        downloadResumableUrlIfNeeded(setPackageUrl, os.path.join(outputDirs['system'], setPackageFilename), 'sets_package')
-    
-    outputDirs['setPackageFilenames'] = setPackageFilenames
+    setPackageFilenames = setPackageFilenamesForVersion(openBSDVersionString)
+    # The set packages are independent of each other, so fetch several at once to hide per-file latency.
+    # Progress meters would garble each other's output, so they're turned off here.
+    with ThreadPoolExecutor(max_workers=SET_PACKAGE_DOWNLOAD_THREADS) as executor:
+        downloads = list()
+        for setPackageFilename in setPackageFilenames:
+            print("Downloading '%s'..." % setPackageFilename)
+            setPackageUrl = urljoin(archSetsUrl, setPackageFilename)
+            downloads.append(executor.submit(downloadResumableUrlIfNeeded, setPackageUrl, os.path.join(outputDirs['system'], setPackageFilename), 'sets_package', False))
+        for download in as_completed(downloads):
+            download.result() # re-raise any failure
+    
+    outputDirs['setPackageFilenames'] = list(setPackageFilenames)
 
     return outputDirs
 
 
 def extractFilesFromTarIntoFlatDirectory(tarPath, memberPaths, destDir):
-    with tempfile.TemporaryDirectory() as tmpDirName:
-        tmpDirPath = Path(tmpDirName)
-        with tarfile.open(tarPath, "r:*") as tar:
-            for memberPath in memberPaths:
-                extractedPath = os.path.join(destDir, os.path.basename(memberPath))
-                tmpFilePath = os.path.join(tmpDirPath, memberPath) # The file is extracted as full path, not a top-level file, so extract in a temporary directory and then move the file up manually
-                debug("Extract tar path %s -> %s -> %s" % (memberPath, tmpFilePath, extractedPath))
-                tar.extract(memberPath, path=tmpDirPath, set_attrs=False)
-                shutil.move(tmpFilePath, extractedPath)
+    # Read the (compressed) archive front to back exactly once, picking out the wanted members as they go by
+    remainingMemberPaths = set(memberPaths)
+    with tarfile.open(tarPath, "r:*") as tar:
+        for member in tar:
+            if member.name not in remainingMemberPaths:
+                continue
+            extractedPath = os.path.join(destDir, os.path.basename(member.name))
+            debug("Extract tar path %s -> %s", member.name, extractedPath)
+            # Stream the member straight to its flattened destination rather than recreating its directory tree
+            memberFile = tar.extractfile(member)
+            assert memberFile is not None, "'%s' in '%s' is not a regular file" % (member.name, tarPath)
+            with memberFile, open(extractedPath, "wb") as extractedFile:
+                shutil.copyfileobj(memberFile, extractedFile, FILE_COPY_CHUNK_SIZE)
+            remainingMemberPaths.remove(member.name)
+            if not remainingMemberPaths:
+                break
+    assert not remainingMemberPaths, "Can't find %r in '%s'" % (sorted(remainingMemberPaths), tarPath)
 
     
 def manifestFileInfo(filename, path, boardnameForImageFlashing = None):
@@ -565,6 +711,37 @@ def manifestFileInfo(filename, path, boardnameForImageFlashing = None):
     return imageInfo
 
 
+def longDirectoryListing(dirPath):
+    # Equivalent to the output of 'ls -l' (less the "total" line), without having to run it
+    now = time.time()
+    rows = list()
+    for entry in sorted(os.scandir(dirPath), key=lambda entry: entry.name):
+        if entry.name.startswith('.'):
+            continue
+        st = entry.stat(follow_symlinks=False)
+        try:
+            owner = pwd.getpwuid(st.st_uid).pw_name
+        except KeyError:
+            owner = str(st.st_uid)
+        try:
+            group = grp.getgrgid(st.st_gid).gr_name
+        except KeyError:
+            group = str(st.st_gid)
+        if abs(now - st.st_mtime) < SET_PACKAGE_DIR_LISTING_RECENT_SECONDS:
+            timestamp = time.strftime("%b %e %H:%M", time.localtime(st.st_mtime))
+        else:
+            timestamp = time.strftime("%b %e  %Y", time.localtime(st.st_mtime))
+        rows.append((stat.filemode(st.st_mode), str(st.st_nlink), owner, group, str(st.st_size), timestamp, entry.name))
+
+    listing = ""
+    if rows:
+        # Right-align the numeric columns and left-align the names, as ls(1) does
+        widths = [ max(len(row[column]) for row in rows) for column in range(5) ]
+        for mode, nlink, owner, group, size, timestamp, name in rows:
+            listing += "%s  %*s %-*s  %-*s  %*s %s %s\n" % (mode, widths[1], nlink, widths[2], owner, widths[3], group, widths[4], size, timestamp, name)
+    return listing
+
+
 def stageImagesForHost(hostdef, downloadDirPaths):
     print("Staging install & set disks...")
 
@@ -632,11 +809,10 @@ def stageImagesForHost(hostdef, downloadDirPaths):
     copyFileIfNeeded(sitePackagePath, setPackageFileDstPath)
     setsDiskManifest.append(manifestFileInfo(sitePackageName, setPackageFileDstPath))
     
-    # Generate index.txt by running 'ls -l' so that it includes our site.tgz file to be picked up by autoinstall    
+    # Generate index.txt, an 'ls -l'-style listing (see longDirectoryListing()), so that it includes our site.tgz file to be picked up by autoinstall
     print("Generating set package directory listing...")
     setPackageDirPath = outputDirs['sets']
-    cmdResult = subprocess.run(["ls", "-l", os.path.abspath(setPackageDirPath)], capture_output = True, encoding="utf-8", check = True)
-    setPackageDirListing = cmdResult.stdout
+    setPackageDirListing = longDirectoryListing(setPackageDirPath)
     setPackageDirListingPath = os.path.join(setPackageDirPath, SET_PACKAGE_DIR_LISTING_FILENAME)
     with open(setPackageDirListingPath, 'w') as dirListingFile:
         dirListingFile.write(setPackageDirListing)
@@ -672,7 +848,9 @@ def generateMasteringImageForHostname(hostname):
 
     downloadDirs = downloadImagesForHost(hostdef)
     
-    diskManifests = stageImagesForHost(hostdef, downloadDirs)
+    # Keep other hosts from re-downloading into the mirror directories while we copy out of them (same lock order as downloading)
+    with downloadDirectoryLock(downloadDirs['system'], fcntl.LOCK_SH), downloadDirectoryLock(downloadDirs['package'], fcntl.LOCK_SH):
+        diskManifests = stageImagesForHost(hostdef, downloadDirs)
 
     print("Finished mastering image for host '%s'." % hostname)
     
@@ -689,8 +867,6 @@ def main(argv):
 
     hostnames = args.hostnames
 
-    completedCount = 0
-
     if hostnames == None or len(hostnames) == 0:
         hostnames = list()
         for hostdef in OortCommon.gHostMap:
@@ -699,9 +875,7 @@ def main(argv):
 
     debug("Hosts enqueued: %r" % hostnames)
     
-    for hostname in hostnames:
-        generateMasteringImageForHostname(hostname)
-        completedCount += 1
+    completedCount = runForEachHost(generateMasteringImageForHostname, hostnames, args)
     
     print("%i mastering image%s generated." % (completedCount, "" if completedCount == 1 else "s"))
 	